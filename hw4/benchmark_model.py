@@ -0,0 +1,125 @@
+"""Benchmark loading of the saved classifier
+
+Compares how long it takes to load the model bundle, and how much
+memory the loaded bundle uses, between the old format (a text-mode
+pickle using the default protocol) and the current format (see
+`ImageClassifier.save`), both with and without memory mapping.
+
+To run the benchmark on a saved classifier:
+
+`python benchmark_model.py trained_classifier.p`
+
+Each load is run in a fresh Python process, so that the timings
+include everything a cold start of `verify.sh` would have to do.
+
+"""
+
+# built-in
+import os
+import pickle
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+# local
+from image_classification import ImageClassifier
+
+
+def load_old(filename):
+    with open(filename, "r") as fh:
+        return pickle.load(fh)
+
+
+def load_new(filename):
+    return ImageClassifier.load(filename, mmap_mode=None)
+
+
+def load_new_mmap(filename):
+    return ImageClassifier.load(filename, mmap_mode='r')
+
+
+LOADERS = {
+    'pickle': load_old,
+    'joblib': load_new,
+    'joblib-mmap': load_new_mmap,
+}
+
+
+def measure(loader, filename):
+    """Load a model bundle in the current process, and return the load
+    time (in seconds) and the increase in peak resident memory (in
+    kilobytes).
+
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    LOADERS[loader](filename)
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    return elapsed, rss
+
+
+def benchmark(filename, repeats=3):
+    """Save the model bundle in both the old and new formats, and then
+    time loading each of them in a fresh process.
+
+    Parameters
+    ----------
+    filename : string
+        Path to the saved model bundle
+    repeats : int (optional)
+        Number of times to load each format
+
+    """
+    model = ImageClassifier.load(filename, mmap_mode=None)
+    tmpdir = tempfile.mkdtemp()
+
+    try:
+        old_filename = os.path.join(tmpdir, "old", "classifier.p")
+        new_filename = os.path.join(tmpdir, "new", "classifier.p")
+        os.makedirs(os.path.dirname(old_filename))
+        os.makedirs(os.path.dirname(new_filename))
+
+        with open(old_filename, "w") as fh:
+            pickle.dump(model.bundle(), fh)
+        model.save(new_filename)
+
+        files = {
+            'pickle': [old_filename],
+            'joblib': [os.path.join(os.path.dirname(new_filename), x)
+                       for x in os.listdir(os.path.dirname(new_filename))],
+        }
+        files['joblib-mmap'] = files['joblib']
+        paths = {
+            'pickle': old_filename,
+            'joblib': new_filename,
+            'joblib-mmap': new_filename,
+        }
+
+        print "%-12s %10s %10s %12s" % (
+            "format", "size (KB)", "load (s)", "memory (KB)")
+        for loader in ['pickle', 'joblib', 'joblib-mmap']:
+            size = sum(os.path.getsize(x) for x in files[loader]) / 1024
+            times = []
+            for i in xrange(repeats):
+                out = subprocess.check_output([
+                    sys.executable, __file__, "--measure", loader,
+                    paths[loader]])
+                elapsed, rss = map(float, out.split())
+                times.append(elapsed)
+            print "%-12s %10d %10.3f %12d" % (loader, size, min(times), rss)
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--measure":
+        print "%f %d" % measure(sys.argv[2], sys.argv[3])
+    elif len(sys.argv) == 2:
+        benchmark(sys.argv[1])
+    else:
+        print "Invalid number of arguments (expected 'forest')."
+        sys.exit(1)
@@ -0,0 +1,267 @@
+"""Benchmark the image featurization and classification pipeline
+
+This script generates a directory of synthetic images (laid out like
+`50_categories/<category>/<image>.jpg`), and then times each stage of
+the pipeline on them:
+
+    * preprocessing: decode, equalize, denoise, rescale (as in
+      `image_processing.load_image`), and the fast path
+    * features: mean, median, covariance, entropy (as in
+      `image_processing.extract_features`)
+    * classification: fitting the scaler and forest, and predicting
+    * the whole (parallel) feature extraction pipeline,
+      `image_processing.load_and_extract`
+
+For each stage it reports the total time and the throughput (images
+per second), along with the peak resident memory of the process. To
+run the benchmark and save the results to a JSON file:
+
+`python benchmark_pipeline.py results.json`
+
+Results from different commits can then be compared with:
+
+`python benchmark_pipeline.py --compare old.json new.json`
+
+"""
+
+# built-in
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+# external
+import numpy as np
+import skimage.exposure
+import skimage.filter
+import skimage.filter.rank
+import skimage.io
+import skimage.morphology
+import skimage.transform
+from PIL import Image
+# local
+import image_processing as ip
+from image_classification import train_classifier
+
+
+def make_images(path, ncategories=5, nimages=10, size=(640, 480),
+                rso=None):
+    """Generate a directory of synthetic JPEG images, with each
+    category having a different color and texture.
+
+    Parameters
+    ----------
+    path : string
+        Directory to create the category subdirectories in
+    ncategories : int (optional)
+        Number of categories
+    nimages : int (optional)
+        Number of images per category
+    size : tuple (optional)
+        Width and height of each image
+    rso : numpy.random.RandomState (optional)
+        Random state object
+
+    Returns
+    -------
+    images : list
+        List of paths to the generated images
+
+    """
+    if rso is None:
+        rso = np.random
+    width, height = size
+    images = []
+    for i in xrange(ncategories):
+        category_dir = os.path.join(path, "category%02d" % i)
+        os.makedirs(category_dir)
+        color = rso.rand(3) * 255
+        for j in xrange(nimages):
+            noise = rso.randn(height, width, 3) * 10 * (i + 1)
+            img = np.clip(color + noise, 0, 255).astype('uint8')
+            filename = os.path.join(category_dir, "%04d.jpg" % j)
+            Image.fromarray(img).save(filename)
+            images.append(filename)
+    return images
+
+
+class Timer(object):
+    """Accumulates the total time spent in each of several stages."""
+
+    def __init__(self):
+        self.times = OrderedDict()
+
+    def time(self, name, func, *args, **kwargs):
+        """Call a function, adding the time it takes to stage `name`,
+        and return its result.
+
+        """
+        start = time.time()
+        result = func(*args, **kwargs)
+        elapsed = time.time() - start
+        self.times[name] = self.times.get(name, 0.) + elapsed
+        return result
+
+
+def benchmark_preprocessing(images, timer, n=ip.IMAGE_SIZE):
+    """Time each step of `load_image`, followed by the whole fast
+    path. Returns the preprocessed images.
+
+    """
+    imgs = []
+    for image_path in images:
+        # these steps mirror image_processing.load_image
+        img = timer.time("decode", skimage.io.imread, image_path)
+        img = img.astype('f8')
+        if img.ndim == 2:
+            img = img[:, :, None] * np.ones(img.shape + (3,))
+        img = timer.time("equalize", skimage.exposure.equalize_hist, img)
+        img = timer.time(
+            "denoise", skimage.filter.denoise_bilateral, img, 3, 0.1)
+        scale = float(n) / max(img.shape[:2])
+        img = timer.time("rescale", skimage.transform.rescale, img, scale)
+        imgs.append(img)
+
+        timer.time("preprocess_fast", ip.load_image, image_path, fast=True)
+
+    return imgs
+
+
+def benchmark_features(imgs, timer):
+    """Time the computation of each feature in `extract_features`.
+    Returns the feature array.
+
+    """
+    selem = skimage.morphology.disk(ip.ENTROPY_RADIUS)
+    for img in imgs:
+        # these steps mirror image_processing.extract_features
+        RGB = img.reshape((-1, 3)).T
+        timer.time("feature_mean", np.mean, RGB, axis=1)
+        timer.time("feature_median", np.median, RGB, axis=1)
+        timer.time("feature_cov", np.cov, RGB)
+        gray = np.mean(img, axis=-1).astype('uint16')
+        timer.time(
+            "feature_entropy", skimage.filter.rank.entropy, gray, selem)
+
+    features = [timer.time("extract_features", ip.extract_features, img)
+                for img in imgs]
+    return np.array(features, dtype='f4')
+
+
+def benchmark_classification(X, Y, category_map, timer, rso=None):
+    """Time fitting the scaler and classifier, and predicting."""
+    model = timer.time(
+        "fit_classifier", train_classifier, X, Y, rso=rso,
+        category_map=category_map)
+    timer.time("predict", model.predict, X)
+
+
+def git_commit():
+    """Get the hash of the current git commit, if there is one."""
+    try:
+        out = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.strip()
+
+
+def benchmark(ncategories=5, nimages=10, size=(640, 480), seed=0):
+    """Run the full benchmark on a freshly generated set of synthetic
+    images.
+
+    Returns
+    -------
+    results : dict
+        The benchmark parameters, the time and throughput of each
+        stage, and the peak resident memory (in kilobytes)
+
+    """
+    rso = np.random.RandomState(seed)
+    tmpdir = tempfile.mkdtemp()
+    timer = Timer()
+
+    try:
+        images = make_images(
+            tmpdir, ncategories=ncategories, nimages=nimages, size=size,
+            rso=rso)
+        Y, category_map = ip.get_image_categories(images)
+
+        imgs = benchmark_preprocessing(images, timer)
+        X = benchmark_features(imgs, timer)
+        benchmark_classification(X, Y, category_map, timer, rso=rso)
+
+        # the whole feature extraction pipeline, using all CPUs
+        timer.time("load_and_extract", ip.load_and_extract, images,
+                   nprocs=None)
+
+    finally:
+        shutil.rmtree(tmpdir)
+
+    stages = OrderedDict()
+    for name, total in timer.times.items():
+        stages[name] = {
+            'time': total,
+            'images_per_s': len(images) / total if total > 0 else None
+        }
+
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'feature_version': ip.feature_version(),
+        'params': {
+            'ncategories': ncategories,
+            'nimages': nimages,
+            'size': list(size),
+            'seed': seed
+        },
+        'stages': stages,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def report(results):
+    """Print the time and throughput of each stage."""
+    print "Commit: %s" % results['commit']
+    print "%-18s %10s %12s" % ("stage", "time (s)", "images/s")
+    for name, stage in results['stages'].items():
+        print "%-18s %10.3f %12.2f" % (
+            name, stage['time'], stage['images_per_s'] or np.inf)
+    print "Peak RSS: %.1f MB" % (results['peak_rss_kb'] / 1024.)
+
+
+def compare(old, new):
+    """Print the speedup of each stage between two sets of results."""
+    print "Comparing %s to %s" % (old['commit'], new['commit'])
+    print "%-18s %10s %10s %10s" % (
+        "stage", "old (s)", "new (s)", "speedup")
+    for name, stage in new['stages'].items():
+        if name not in old['stages']:
+            continue
+        old_time = old['stages'][name]['time']
+        print "%-18s %10.3f %10.3f %9.2fx" % (
+            name, old_time, stage['time'], old_time / stage['time'])
+    print "Peak RSS: %.1f MB -> %.1f MB" % (
+        old['peak_rss_kb'] / 1024., new['peak_rss_kb'] / 1024.)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--compare":
+        with open(sys.argv[2], "r") as fh:
+            old = json.load(fh, object_pairs_hook=OrderedDict)
+        with open(sys.argv[3], "r") as fh:
+            new = json.load(fh, object_pairs_hook=OrderedDict)
+        compare(old, new)
+        sys.exit(0)
+
+    results = benchmark()
+    report(results)
+
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "w") as fh:
+            json.dump(results, fh, indent=2)
+        print "Results saved to '%s'" % sys.argv[1]
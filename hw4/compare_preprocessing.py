@@ -0,0 +1,111 @@
+"""Compare the normal and fast preprocessing paths
+
+The fast preprocessing path (see `image_processing.load_image`)
+resizes images before equalizing and denoising them, so the features
+it produces are slightly different. This script computes features for
+a sample of images both ways, and reports how much faster the fast
+path is, and how much each feature drifts.
+
+To compare on (up to) 100 images from the training set, run:
+
+`python compare_preprocessing.py 50_categories 100`
+
+For each feature, the drift is reported as the mean absolute
+difference between the two paths, relative to the standard deviation
+of that feature across images, along with the correlation between the
+two paths.
+
+"""
+
+# built-in
+import sys
+import time
+from glob import glob
+# external
+import numpy as np
+# local
+from image_processing import FEATURE_NAMES, load_image, extract_features
+
+
+def compare(images):
+    """Compute features for a list of images using both the normal
+    and fast preprocessing paths.
+
+    Parameters
+    ----------
+    images : list
+        List of paths to images
+
+    Returns
+    -------
+    features : dict
+        The (N, M) feature arrays, keyed by whether the fast path was
+        used
+    times : dict
+        Total preprocessing and feature extraction times (in seconds),
+        keyed by whether the fast path was used
+
+    """
+    features = {False: [], True: []}
+    times = {False: [0., 0.], True: [0., 0.]}
+
+    for i, image_path in enumerate(images):
+        msg = "[%d / %d] %s" % (i, len(images), image_path)
+        sys.stdout.write(msg + "\r")
+        sys.stdout.flush()
+
+        for fast in (False, True):
+            start = time.time()
+            img = load_image(image_path, fast=fast)
+            mid = time.time()
+            features[fast].append(extract_features(img))
+            end = time.time()
+            times[fast][0] += mid - start
+            times[fast][1] += end - mid
+
+        sys.stdout.write(" "*len(msg) + "\r")
+
+    for fast in (False, True):
+        features[fast] = np.array(features[fast])
+
+    return features, times
+
+
+def report(features, times):
+    """Print the speedup of the fast path, and the drift of each
+    feature.
+
+    """
+    n = len(features[False])
+    print "%-12s %12s %12s %12s" % (
+        "", "preprocess", "features", "images/s")
+    for fast, name in [(False, "normal"), (True, "fast")]:
+        load_time, extract_time = times[fast]
+        print "%-12s %11.3fs %11.3fs %12.2f" % (
+            name, load_time, extract_time, n / (load_time + extract_time))
+    print "Preprocessing speedup: %.1fx" % (times[False][0] / times[True][0])
+    print "Overall speedup: %.1fx" % (sum(times[False]) / sum(times[True]))
+    print
+
+    F0 = features[False]
+    F1 = features[True]
+    drift = np.mean(np.abs(F1 - F0), axis=0) / np.std(F0, axis=0)
+    print "%-14s %12s %12s" % ("feature", "drift", "correlation")
+    for i, name in enumerate(FEATURE_NAMES):
+        corr = np.corrcoef(F0[:, i], F1[:, i])[0, 1]
+        print "%-14s %12.4f %12.4f" % (name, drift[i], corr)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Invalid number of arguments (expected 'path')."
+        sys.exit(1)
+
+    images = sorted(glob("%s/*/*.jpg" % sys.argv[1]))
+    if len(sys.argv) > 2:
+        # take an evenly spaced sample, so all categories are included
+        num = int(sys.argv[2])
+        step = max(1, len(images) / num)
+        images = images[::step][:num]
+
+    report(*compare(images))
@@ -0,0 +1,215 @@
+"""On-disk cache of image feature vectors
+
+Feature vectors are saved as individual numpy files, keyed by a hash
+of the image file contents and by the version of the feature
+extraction parameters (see `image_processing.feature_version`). This
+means that renaming or copying an image doesn't require recomputing
+its features, while changing an image (or the way features are
+computed) does.
+
+The cache is laid out on disk like so:
+
+    feature_cache/<version>/<hash[:2]>/<hash>.npy
+
+When the total size of the cache grows larger than `max_size` bytes,
+the least recently used feature files are deleted until it is back
+down to a fraction (`low_water`) of that size. The size and last use
+time of each file are kept in an in-memory index, which is built (by
+walking the cache directory) the first time it is needed and then
+shared by every `FeatureCache` on the same directory in this process,
+so inserting a feature vector doesn't require scanning the cache.
+
+"""
+
+# built-in
+import hashlib
+import os
+import tempfile
+import time
+# external
+import numpy as np
+
+
+def hash_file(path, blocksize=2**20):
+    """Compute the SHA-1 hash of a file's contents.
+
+    Parameters
+    ----------
+    path : string
+        The path to the file
+    blocksize : int (optional)
+        Number of bytes to read at a time
+
+    Returns
+    -------
+    string : hexadecimal digest
+
+    """
+    sha = hashlib.sha1()
+    with open(path, "rb") as fh:
+        while True:
+            block = fh.read(blocksize)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+# in-memory indexes of the cache directories, keyed by absolute path
+# (see `FeatureCache.index`)
+_indexes = {}
+
+
+class _CacheIndex(object):
+    """The size and last use time of each file in a cache directory,
+    and the total size of all of them.
+
+    """
+
+    def __init__(self, path):
+        self.files = {}
+        self.size = 0
+        for root, dirs, filenames in os.walk(path):
+            for filename in filenames:
+                if not filename.endswith(".npy"):
+                    continue
+                filename = os.path.join(root, filename)
+                stat = os.stat(filename)
+                self.add(filename, stat.st_size, stat.st_mtime)
+
+    def add(self, filename, size, mtime):
+        self.remove(filename)
+        self.files[filename] = (size, mtime)
+        self.size += size
+
+    def remove(self, filename):
+        if filename in self.files:
+            self.size -= self.files.pop(filename)[0]
+
+    def touch(self, filename):
+        if filename in self.files:
+            size, mtime = self.files[filename]
+            self.files[filename] = (size, time.time())
+
+
+class FeatureCache(object):
+    """A persistent, size-bounded cache of feature vectors.
+
+    Parameters
+    ----------
+    version : string
+        Version of the feature extraction parameters. Features
+        computed with different versions are stored separately.
+    path : string (optional)
+        Root directory of the cache
+    max_size : int (optional)
+        Maximum total size of the cache, in bytes
+    low_water : float (optional)
+        When the cache grows larger than `max_size`, files are deleted
+        until it is no larger than this fraction of `max_size`
+
+    """
+
+    def __init__(self, version, path="feature_cache", max_size=2**30,
+                 low_water=0.9):
+        self.version = version
+        self.path = path
+        self.max_size = max_size
+        self.low_water = low_water
+
+        # make the cache directory if it does not exist
+        if not os.path.exists(os.path.join(path, version)):
+            os.makedirs(os.path.join(path, version))
+
+    @property
+    def index(self):
+        """The index of the files in the cache (across all versions).
+        It is only built from the files on disk the first time it is
+        needed, and is shared by all caches with the same path.
+
+        """
+        root = os.path.abspath(self.path)
+        if root not in _indexes:
+            _indexes[root] = _CacheIndex(root)
+        return _indexes[root]
+
+    @property
+    def size(self):
+        """Total size of everything currently in the cache."""
+        return self.index.size
+
+    def _filename(self, key):
+        return os.path.join(self.path, self.version, key[:2], key + ".npy")
+
+    def key(self, image_path):
+        """Compute the cache key for an image."""
+        return hash_file(image_path)
+
+    def load(self, key):
+        """Load a feature vector from the cache, without marking it as
+        recently used. Returns None if it is not in the cache.
+
+        """
+        try:
+            return np.load(self._filename(key))
+        except (IOError, ValueError):
+            return None
+
+    def touch(self, key):
+        """Mark a feature vector in the cache as recently used."""
+        filename = self._filename(key)
+        try:
+            os.utime(filename, None)
+        except OSError:
+            return
+        root = os.path.abspath(self.path)
+        if root in _indexes:
+            _indexes[root].touch(os.path.abspath(filename))
+
+    def get(self, key):
+        """Load a feature vector from the cache, and mark it as
+        recently used. Returns None if it is not in the cache.
+
+        """
+        features = self.load(key)
+        if features is not None:
+            self.touch(key)
+        return features
+
+    def put(self, key, features):
+        """Save a feature vector to the cache."""
+        filename = self._filename(key)
+        dirname = os.path.dirname(filename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        # write to a temporary file first and then move it into place,
+        # so that an interrupted write never leaves a partial file
+        fd, tmpname = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            np.save(fh, features)
+            size = fh.tell()
+        os.rename(tmpname, filename)
+
+        index = self.index
+        index.add(os.path.abspath(filename), size, time.time())
+        if index.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Delete the least recently used files until the cache is no
+        larger than `low_water` times `max_size`.
+
+        """
+        index = self.index
+        target = self.low_water * self.max_size
+        files = sorted(index.files.items(), key=lambda x: x[1][1])
+        for filename, (size, mtime) in files:
+            if index.size <= target:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                # already deleted (e.g. by another process)
+                pass
+            index.remove(filename)
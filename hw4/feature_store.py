@@ -0,0 +1,208 @@
+"""Append-only, memory-mapped store of image features
+
+Rows are written to disk as soon as each image's features have been
+computed, so an interrupted feature extraction can be resumed where it
+left off, and new images can be added without rewriting the existing
+data. The features can be loaded as a memory map, so they never need
+to be read fully into memory.
+
+A store is a directory with the following layout:
+
+    header.json -- feature version, number of features, category names
+    features.f4 -- raw float32 feature array, one row per image
+    rows.txt    -- one line per row: "<category index>\t<image path>"
+
+"""
+
+# built-in
+import json
+import os
+# external
+import numpy as np
+
+
+class FeatureStore(object):
+    """An append-only store of feature vectors, along with the path
+    and category of the image each one was computed from.
+
+    Parameters
+    ----------
+    path : string
+        Directory containing the store. It is created if it does not
+        exist.
+    version : string
+        Version of the feature extraction parameters (see
+        `image_processing.feature_version`). Opening an existing store
+        with a different version raises a ValueError.
+    mode : string (optional)
+        'a' to open the store for appending, or 'r' to open it
+        read-only. Only a store opened for appending repairs the
+        files after an interrupted `append`; a read-only store just
+        ignores any incomplete rows, so it can safely be opened while
+        another process is still appending to it.
+
+    """
+
+    dtype = np.dtype('f4')
+
+    def __init__(self, path, version, mode='a'):
+        if mode not in ('a', 'r'):
+            raise ValueError("invalid mode: %r" % mode)
+        self.path = path
+        self.version = version
+        self.mode = mode
+
+        self.nfeatures = None
+        self.category_map = []
+        self.image_paths = []
+        self.category_indices = []
+
+        # make the store directory if it does not exist
+        if not os.path.exists(path):
+            if mode == 'r':
+                raise IOError("feature store '%s' does not exist" % path)
+            os.makedirs(path)
+
+        if os.path.exists(self._filename("header.json")):
+            with open(self._filename("header.json"), "r") as fh:
+                header = json.load(fh)
+            if header['version'] != version:
+                raise ValueError(
+                    "feature store '%s' has version %s, expected %s" % (
+                        path, header['version'], version))
+            self.nfeatures = header['nfeatures']
+            self.category_map = header['category_map']
+
+        if os.path.exists(self._filename("rows.txt")):
+            with open(self._filename("rows.txt"), "r") as fh:
+                for line in fh:
+                    # skip a partially written last line
+                    if not line.endswith("\n"):
+                        break
+                    category, image_path = line[:-1].split("\t", 1)
+                    self.category_indices.append(int(category))
+                    self.image_paths.append(image_path)
+
+        if mode == 'a':
+            self._recover()
+        else:
+            nrows = self._complete_rows()
+            del self.image_paths[nrows:]
+            del self.category_indices[nrows:]
+        self._path_set = set(self.image_paths)
+
+    def _filename(self, name):
+        return os.path.join(self.path, name)
+
+    def _complete_rows(self):
+        """Get the number of rows which have been completely written,
+        i.e. which are in both the features and rows files.
+
+        """
+        features_file = self._filename("features.f4")
+        if self.nfeatures is None or not os.path.exists(features_file):
+            return 0
+        rowsize = self.nfeatures * self.dtype.itemsize
+        nrows = os.path.getsize(features_file) / rowsize
+        return min(nrows, len(self.image_paths))
+
+    def _recover(self):
+        """Make sure the features and rows files agree about how many
+        rows there are, truncating whichever one is longer (which can
+        happen if an earlier process was killed during `append`).
+
+        """
+        nrows = self._complete_rows()
+        features_file = self._filename("features.f4")
+        if os.path.exists(features_file):
+            rowsize = (self.nfeatures or 0) * self.dtype.itemsize
+            with open(features_file, "r+b") as fh:
+                fh.truncate(nrows * rowsize)
+
+        del self.image_paths[nrows:]
+        del self.category_indices[nrows:]
+        with open(self._filename("rows.txt"), "w") as fh:
+            for category, image_path in zip(
+                    self.category_indices, self.image_paths):
+                fh.write("%d\t%s\n" % (category, image_path))
+
+    def _write_header(self):
+        if self.mode != 'a':
+            raise IOError("feature store '%s' is read-only" % self.path)
+        # write to a temporary file and then move it into place, so
+        # the header is never left partially written
+        tmpname = self._filename("header.json.tmp")
+        with open(tmpname, "w") as fh:
+            json.dump({
+                'version': self.version,
+                'nfeatures': self.nfeatures,
+                'category_map': self.category_map
+            }, fh)
+        os.rename(tmpname, self._filename("header.json"))
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __contains__(self, image_path):
+        return image_path in self._path_set
+
+    def add_categories(self, categories):
+        """Add category names to the category map. Categories which
+        are already in the map keep their existing index.
+
+        """
+        new = [c for c in categories if c not in self.category_map]
+        if new:
+            self.category_map.extend(new)
+            self._write_header()
+
+    def append(self, image_path, category, features):
+        """Append a feature vector to the store.
+
+        Parameters
+        ----------
+        image_path : string
+            Path to the image the features were computed from
+        category : string
+            Name of the image's category
+        features : (M,) numpy.ndarray
+            Feature vector
+
+        """
+        if self.mode != 'a':
+            raise IOError("feature store '%s' is read-only" % self.path)
+        features = np.asarray(features, dtype=self.dtype).ravel()
+        if self.nfeatures is None:
+            self.nfeatures = features.size
+            self._write_header()
+        elif features.size != self.nfeatures:
+            raise ValueError("expected %d features, got %d" % (
+                self.nfeatures, features.size))
+        self.add_categories([category])
+        category_idx = self.category_map.index(category)
+
+        # write the features before the row, so a row is never
+        # recorded without its features
+        with open(self._filename("features.f4"), "ab") as fh:
+            fh.write(features.tostring())
+        with open(self._filename("rows.txt"), "a") as fh:
+            fh.write("%d\t%s\n" % (category_idx, image_path))
+
+        self.image_paths.append(image_path)
+        self.category_indices.append(category_idx)
+        self._path_set.add(image_path)
+
+    def features(self):
+        """Get the (N, M) feature array as a read-only memory map."""
+        if len(self) == 0:
+            return np.empty((0, self.nfeatures or 0), dtype=self.dtype)
+        return np.memmap(
+            self._filename("features.f4"), dtype=self.dtype, mode='r',
+            shape=(len(self), self.nfeatures))
+
+    def categories(self):
+        """Get the (N,) array of integer categories. The integers are
+        indices into `category_map`.
+
+        """
+        return np.array(self.category_indices, dtype='i4')
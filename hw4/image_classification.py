@@ -14,14 +14,30 @@ run_final_classifier("directory_name", "pickled_classifier")
 
 This will load the images in that directory, compute their features,
 and attempt to classify them. The results will be printed to standard
-out as well as being saved to a text file called `results.txt`.
+out as well as being saved to a text file called `results.txt`. The
+images are classified in batches, so results are written as soon as
+each batch is done.
+
+The pickled classifier file is a model bundle (see `ImageClassifier`),
+which holds the random forest along with the feature scaler that was
+fit to the training data, the category names, and the version of the
+feature extraction parameters. To classify a single image:
+
+```
+from image_classification import ImageClassifier
+model = ImageClassifier.load("trained_classifier.p")
+model.classify_image("path/to/image.jpg")
+```
 
 """
 
 # built-in
+import multiprocessing
 import os
-import pickle
+import shutil
 import sys
+import tempfile
+import time
 import warnings
 from glob import glob
 from itertools import izip
@@ -34,52 +50,336 @@ from sklearn.metrics import confusion_matrix
 from sklearn.metrics import accuracy_score
 from sklearn.cross_validation import KFold
 from sklearn import preprocessing
+from sklearn.externals import joblib
 # local
-from image_processing import load_and_extract
+from feature_cache import FeatureCache
+from feature_store import FeatureStore
+from image_processing import extract_features, feature_version
+from image_processing import iter_features, load_image
 
 # turn off warnings
 warnings.filterwarnings('ignore')
 
 
-def train_classifier(X, Y, save=False, rso=None):
-    """Train a random forest classifier on the data.
+def load_dataset(path="image_dataset", fast=False):
+    """Load the training features and categories computed by
+    `image_processing.py`. The features are memory mapped rather than
+    read into memory.
 
     Parameters
     ----------
+    path : str (optional)
+        Either the directory of a feature store (see
+        `feature_store.py`), or an older `.npy` file whose last column
+        holds the categories.
+    fast : bool (optional)
+        Whether the features in the store were computed with the fast
+        preprocessing path (see `image_processing.load_image`)
+
+    Returns
+    -------
     X : (N, M) numpy.ndarray
         Feature array, where N is the number of data points and M is
         the number of features.
+    Y : (N,) numpy.ndarray
+        Observation vector, where N is the number of observations.
+
+    """
+    if os.path.isdir(path):
+        store = FeatureStore(path, feature_version(fast=fast), mode='r')
+        return store.features(), store.categories()
+
+    dataset = np.load(path, mmap_mode='r')
+    return dataset[:, :-1], dataset[:, -1]
+
+
+def fit_scaler(X):
+    """Fit a scaler which standardizes each feature to have zero mean
+    and unit variance (like `preprocessing.scale`). The same scaler
+    should be used to transform both the training data and any new
+    data that is classified later.
+
+    Parameters
+    ----------
+    X : (N, M) numpy.ndarray
+        Feature array, where N is the number of data points and M is
+        the number of features.
+
+    Returns
+    -------
+    scaler : sklearn.preprocessing.StandardScaler
+
+    """
+    scaler = preprocessing.StandardScaler()
+    scaler.fit(X)
+    return scaler
+
+
+class ImageClassifier(object):
+    """A trained classifier, bundled together with everything needed to
+    classify new images: the scaler that was fit to the training
+    features, the category names, and the version of the feature
+    extraction parameters the classifier was trained with.
+
+    Parameters
+    ----------
+    clf : sklearn.ensemble.RandomForestClassifier
+        The trained classifier
+    scaler : sklearn.preprocessing.StandardScaler
+        The scaler that was fit to the training data
+    category_map : list
+        A list of category names. The predicted category integers are
+        indices into this list. It may be None if the model is only
+        used to predict category integers (and is not saved).
+    fast : bool (optional)
+        Whether the classifier was trained on features computed with
+        the fast preprocessing path (see `image_processing.load_image`)
+
+    """
+
+    # version of the saved model bundle format
+    format_version = 1
+
+    def __init__(self, clf, scaler, category_map, fast=False):
+        self.clf = clf
+        self.scaler = scaler
+        if category_map is not None:
+            category_map = list(category_map)
+        self.category_map = category_map
+        self.fast = fast
+        self.version = feature_version(fast=fast)
+
+    def predict(self, X):
+        """Predict (integer) categories from an (N, M) array of
+        unscaled features.
+
+        """
+        X = self.scaler.transform(np.asarray(X, dtype='f4'))
+        return self.clf.predict(X).astype('i4')
+
+    def classify_image(self, image_path):
+        """Load an image, compute its features, and return the name of
+        its predicted category.
+
+        """
+        img = load_image(image_path, fast=self.fast)
+        img_features = extract_features(img)
+        pred = self.predict(img_features[None])[0]
+        return self.category_map[pred]
+
+    def bundle(self):
+        """Get a dictionary of everything that is saved with the
+        model.
+
+        """
+        return {
+            'format_version': self.format_version,
+            'feature_version': self.version,
+            'classifier': self.clf,
+            'scaler': self.scaler,
+            'category_map': self.category_map
+        }
+
+    def save(self, filename):
+        """Save the model bundle to disk with joblib, which writes
+        numpy arrays (including the arrays that make up each tree of
+        the forest) as raw data rather than pickling them element by
+        element. Depending on the joblib version, the arrays may be
+        written to separate files next to `filename`.
+
+        """
+        if self.category_map is None:
+            raise ValueError("the category names are required to save "
+                             "the model")
+        joblib.dump(self.bundle(), filename)
+
+    @classmethod
+    def load(cls, filename, mmap_mode='r'):
+        """Load a model bundle that was saved with `save`. Raises a
+        ValueError if the file is not a model bundle (e.g. a bare
+        classifier pickled by an older version of this code), or if
+        the bundle was created with different feature extraction
+        parameters than the current ones.
+
+        `mmap_mode` is passed to `joblib.load`. Memory mapping makes
+        loading slightly faster, but doesn't save memory: when the
+        forest is unpickled, each tree copies its arrays into its own
+        buffers, so all of the trees are read in at load time either
+        way (see `benchmark_model.py`).
+
+        """
+        bundle = joblib.load(filename, mmap_mode=mmap_mode)
+
+        if not isinstance(bundle, dict) or 'format_version' not in bundle:
+            raise ValueError(
+                "'%s' is not a model bundle (it may be a classifier saved "
+                "by an older version); retrain it with "
+                "train_classifier(..., save=True)" % filename)
+        if bundle['format_version'] != cls.format_version:
+            raise ValueError("unsupported model format: %s" % (
+                bundle['format_version']))
+        for fast in (False, True):
+            if bundle['feature_version'] == feature_version(fast=fast):
+                break
+        else:
+            raise ValueError(
+                "model was trained on features with version %s, but the "
+                "current version is %s" % (
+                    bundle['feature_version'], feature_version()))
+
+        return cls(bundle['classifier'], bundle['scaler'],
+                   bundle['category_map'], fast=fast)
+
+
+def train_classifier(X, Y, save=False, rso=None, category_map=None,
+                     fast=False, **params):
+    """Train a random forest classifier on the data. The features are
+    standardized first, with a scaler that is fit to `X` (see
+    `fit_scaler`) and kept with the classifier, so that new data is
+    always scaled the same way as the training data.
+
+    Parameters
+    ----------
+    X : (N, M) numpy.ndarray
+        Unscaled feature array, where N is the number of data points
+        and M is the number of features.
     Y : (N,) numpy.ndarray
         Observation vectory, where N is the number of observations.
     save : bool (optional)
-        Whether to save (pickle) the classifier to disk
+        Whether to save the classifier to disk, as a model bundle (see
+        `ImageClassifier`) in 'trained_classifier.p'
     rso : numpy.random.RandomState (optional)
         Random state object
+    category_map : list (optional)
+        A list of category names. If not given and `save` is True, it
+        is loaded from 'image_categories.npy'.
+    fast : bool (optional)
+        Whether `X` was computed with the fast preprocessing path
+        (see `image_processing.load_image`); this is saved along with
+        the classifier.
+
+    Any other keyword arguments are passed to the
+    RandomForestClassifier (overriding the defaults used here).
 
     Returns
     -------
-    clf : sklear.ensemble.RandomForestClassifier
+    model : ImageClassifier
+        The trained classifier (`model.clf`) and the scaler that was
+        fit to `X` (`model.scaler`). Use `model.predict` to classify
+        unscaled features.
 
     """
-    clf = RandomForestClassifier(
+    X = np.asarray(X, dtype='f4')
+    scaler = fit_scaler(X)
+
+    kwargs = dict(
         n_estimators=50,
         n_jobs=-1,
         compute_importances=True,
         random_state=rso)
-    clf.fit(X, Y)
+    kwargs.update(params)
+    clf = RandomForestClassifier(**kwargs)
+    clf.fit(scaler.transform(X), Y)
+
+    if save and category_map is None:
+        category_map = np.load("image_categories.npy")
+    model = ImageClassifier(clf, scaler, category_map, fast=fast)
 
-    # optionally save the pickled classifier to disk
+    # optionally save the classifier to disk, along with everything
+    # else needed to classify new images
     if save:
-        with open("trained_classifier.p", "w") as fh:
-            pickle.dump(clf, fh)
+        model.save("trained_classifier.p")
+
+    return model
+
+
+def predict_forest(X_train, Y_train, X_test, rso=None, **params):
+    """Train a random forest classifier and use it to predict the
+    categories of the test data. This can be passed as `predict_func`
+    to `cross_validate` or `sweep`; any keyword arguments are passed
+    on to `train_classifier`.
+
+    Because folds are usually run in parallel, each forest is trained
+    in a single process unless `n_jobs` is given.
+
+    """
+    params.setdefault('n_jobs', 1)
+    model = train_classifier(
+        X_train, Y_train, save=False, rso=rso, **params)
+    return model.predict(X_test)
+
+
+def _run_fold(args):
+    """Run a single cross validation fold (in a worker process), and
+    return the accuracy and the time it took.
+
+    """
+    data_dir, predict_func, params, train_idx, test_idx, seed = args
 
-    return clf
+    # the data is memory mapped, so it is shared between processes
+    # rather than copied to each of them
+    X = np.load(os.path.join(data_dir, "X.npy"), mmap_mode='r')
+    Y = np.load(os.path.join(data_dir, "Y.npy"), mmap_mode='r')
 
+    start = time.time()
+    rso = np.random.RandomState(seed)
+    Y_pred = predict_func(
+        X[train_idx], Y[train_idx], X[test_idx], rso=rso, **params)
+    accuracy = accuracy_score(Y[test_idx], Y_pred)
+    elapsed = time.time() - start
 
-def cross_validate(X, Y, predict_func, nidx=10, rso=None):
+    return accuracy, elapsed
+
+
+def _run_folds(X, Y, jobs, nprocs=1):
+    """Run a list of cross validation jobs, optionally in parallel,
+    yielding the accuracy and time for each of them in order.
+
+    Each job is a tuple of (predict_func, params, train_idx, test_idx,
+    seed).
+
+    """
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+
+    # save the data to disk, so that the worker processes can memory
+    # map it
+    data_dir = tempfile.mkdtemp()
+    np.save(os.path.join(data_dir, "X.npy"), X)
+    np.save(os.path.join(data_dir, "Y.npy"), Y)
+    args = [(data_dir,) + job for job in jobs]
+
+    pool = None
+    try:
+        if nprocs > 1:
+            pool = multiprocessing.Pool(nprocs)
+            results = pool.imap(_run_fold, args)
+        else:
+            results = (_run_fold(x) for x in args)
+        for result in results:
+            yield result
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        shutil.rmtree(data_dir)
+
+
+def _fold_seeds(nidx, rso=None):
+    """Draw a random seed for each fold, so that the results are the
+    same regardless of how (or in what order) the folds are run.
+
+    """
+    if rso is None:
+        rso = np.random
+    return rso.randint(0, 2**31 - 1, nidx)
+
+
+def cross_validate(X, Y, predict_func, nidx=10, rso=None, nprocs=1):
     """Cross validate a classifier using k-fold cross validation, and
-    print out the accuracy for each fold and then the mean and
-    standard error across folds.
+    print out the accuracy (and time taken) for each fold and then the
+    mean and standard error across folds.
 
     Parameters
     ----------
@@ -92,19 +392,28 @@ def cross_validate(X, Y, predict_func, nidx=10, rso=None):
         The prediction function, which should have the following call
         signature:
             predict_funct(X_train, Y_train, X_test, rso=None)
+        To run folds in parallel, this must be picklable (i.e.,
+        defined at the top level of a module).
     nidx : int (optional)
         The number of folds to use
     rso : numpy.random.RandomState (optional)
-        Random state object
+        Random state object. It is used to draw a separate seed for
+        each fold.
+    nprocs : int (optional)
+        Number of worker processes to run folds in. If None, one
+        process per CPU is used.
 
     """
-    indices = KFold(Y.size, n_folds=nidx, random_state=rso)
+    indices = list(KFold(Y.size, n_folds=nidx, random_state=rso))
+    seeds = _fold_seeds(nidx, rso=rso)
+    jobs = [(predict_func, {}, train_idx, test_idx, seed)
+            for (train_idx, test_idx), seed in izip(indices, seeds)]
+
     stats = []
-    for i, (train_idx, test_idx) in enumerate(indices):
-        Y_pred = predict_func(X[train_idx], Y[train_idx], X[test_idx], rso=rso)
-        accuracy = accuracy_score(Y[test_idx], Y_pred)
-        print "[%d / %d] Fraction correctly classified: %.3f" % (
-            i+1, nidx, accuracy)
+    results = _run_folds(X, Y, jobs, nprocs=nprocs)
+    for i, (accuracy, elapsed) in enumerate(results):
+        print "[%d / %d] Fraction correctly classified: %.3f (%.1f s)" % (
+            i+1, nidx, accuracy, elapsed)
         sys.stdout.flush()
         stats.append(accuracy)
     mean = np.mean(stats)
@@ -112,6 +421,69 @@ def cross_validate(X, Y, predict_func, nidx=10, rso=None):
     print "Accuracy: %.3f +/- %.3f" % (mean, sem)
 
 
+def sweep(X, Y, predict_func, param_grid, nidx=10, rso=None, nprocs=None):
+    """Cross validate a classifier for each of several sets of
+    parameters. Every (parameters, fold) pair is run as a separate job
+    in the same pool of worker processes, and every set of parameters
+    uses the same folds and per-fold seeds.
+
+    Parameters
+    ----------
+    X : (N, M) numpy.ndarray
+        Feature array, where N is the number of data points and M is
+        the number of features.
+    Y : (N,) numpy.ndarray
+        Observation vectory, where N is the number of observations.
+    predict_func : function
+        The prediction function, which should have the following call
+        signature:
+            predict_funct(X_train, Y_train, X_test, rso=None, **params)
+        e.g. `predict_forest`
+    param_grid : list of dicts
+        The sets of keyword arguments to pass to `predict_func`
+    nidx : int (optional)
+        The number of folds to use
+    rso : numpy.random.RandomState (optional)
+        Random state object
+    nprocs : int (optional)
+        Number of worker processes. If None, one process per CPU is
+        used.
+
+    Returns
+    -------
+    results : list of (params, mean, sem) tuples
+        The mean and standard error of the accuracy for each set of
+        parameters, sorted from most to least accurate
+
+    """
+    indices = list(KFold(Y.size, n_folds=nidx, random_state=rso))
+    seeds = _fold_seeds(nidx, rso=rso)
+    jobs = [(predict_func, params, train_idx, test_idx, seed)
+            for params in param_grid
+            for (train_idx, test_idx), seed in izip(indices, seeds)]
+
+    stats = np.empty((len(param_grid), nidx))
+    results = _run_folds(X, Y, jobs, nprocs=nprocs)
+    for i, (accuracy, elapsed) in enumerate(results):
+        j, k = divmod(i, nidx)
+        print "[%d / %d] %s, fold %d: %.3f (%.1f s)" % (
+            i+1, len(jobs), param_grid[j], k+1, accuracy, elapsed)
+        sys.stdout.flush()
+        stats[j, k] = accuracy
+
+    results = []
+    for params, accuracies in izip(param_grid, stats):
+        mean = np.mean(accuracies)
+        sem = scipy.stats.sem(accuracies)
+        results.append((params, mean, sem))
+    results.sort(key=lambda x: x[1], reverse=True)
+
+    for params, mean, sem in results:
+        print "%s -- Accuracy: %.3f +/- %.3f" % (params, mean, sem)
+
+    return results
+
+
 def display_confusion_matrix(Y_test, Y_pred, normalize=True):
     """Compute and display a confusion matrix for prediction accuracy.
 
@@ -148,7 +520,52 @@ def display_confusion_matrix(Y_test, Y_pred, normalize=True):
     fig.set_figheight(6)
 
 
-def run_final_classifier(path, forest):
+def iter_predictions(images, model, batch_size=100, nprocs=None,
+                     cache=None):
+    """Classify a list of images, yielding predictions in batches as
+    soon as each batch of features has been computed. Features for
+    later batches continue to be computed (by worker processes) while
+    earlier batches are classified.
+
+    Parameters
+    ----------
+    images : list
+        List of paths to images
+    model : ImageClassifier
+        The trained classifier
+    batch_size : int (optional)
+        Number of images to classify at a time
+    nprocs : int (optional)
+        Number of worker processes to use for feature extraction
+    cache : FeatureCache (optional)
+        Cache of previously computed features
+
+    Yields
+    ------
+    image_path : string
+        Path to the image
+    pred : int
+        Predicted (integer) category
+
+    """
+    paths = []
+    batch = []
+
+    it = iter_features(images, nprocs=nprocs, cache=cache, fast=model.fast)
+    for i, image_path, img_features in it:
+        paths.append(image_path)
+        batch.append(img_features)
+
+        # classify the batch once it is full, or we are out of images
+        if len(batch) == batch_size or i == len(images) - 1:
+            Y_pred = model.predict(np.array(batch, dtype='f4'))
+            for pred_path, pred in izip(paths, Y_pred):
+                yield pred_path, pred
+            paths = []
+            batch = []
+
+
+def run_final_classifier(path, forest, batch_size=100, nprocs=None):
     """Run a random forest classifier on a directory of verification
     images. This function saves a file to disk called 'results.txt',
     which is formatted like so:
@@ -162,37 +579,37 @@ def run_final_classifier(path, forest):
     bat_0005.jpg    blimp
     ...
 
-    This function expects the list of categories to already exist in a
-    file 'image_categories.npy'.
+    Images are classified in batches, and each line is written as soon
+    as its batch has been classified. The accuracy score is written
+    at the end.
 
     Parameters
     ----------
     path : str
         Name of the directory containing verification images
     forest : str
-        Name of the pickled random forest classifier file
+        Name of the saved model bundle file (see `ImageClassifier`)
+    batch_size : int (optional)
+        Number of images to classify at a time
+    nprocs : int (optional)
+        Number of worker processes to use for feature extraction (by
+        default, one per CPU)
 
     """
 
     # get the list of images
     images = glob("%s/*/*.jpg" % path)
-    # get the list of categories
-    categories = list(np.load("./image_categories.npy"))
 
-    # compute feature matrix
-    X = preprocessing.scale(load_and_extract(images))
+    # load the classifier, along with the scaler that was fit to the
+    # training data (so the features are scaled the same way
+    # regardless of how many images there are) and the categories
+    model = ImageClassifier.load(forest)
+    categories = model.category_map
 
-    # load the classifier
-    with open(forest, "r") as fh:
-        clf = pickle.load(fh)
-
-    # make predictions
-    Y_pred = clf.predict(X).astype('i4')
-
-    # compute accuracy
+    # true categories, for computing accuracy
     Y = np.array([categories.index(
         os.path.split(os.path.split(c)[0])[1]) for c in images])
-    rfor_accuracy_score = accuracy_score(Y, Y_pred)
+    Y_pred = np.empty(len(images), dtype='i4')
 
     # save the results to file
     results_file = "./results.txt"
@@ -200,17 +617,27 @@ def run_final_classifier(path, forest):
         def write(msg):
             sys.stdout.write(msg)
             fh.write(msg)
+            fh.flush()
 
-        write("Predicted image classes for JESSICA HAMRICK's classifier\n")
-        write("Accuracy score: %s\n\n" % rfor_accuracy_score)
+        write("Predicted image classes for JESSICA HAMRICK's classifier\n\n")
         write("filename\tpredicted_class\n")
         write("-----------------------------------------\n")
 
-        for image, pred in izip(images, Y_pred):
+        # make predictions
+        cache = FeatureCache(model.version)
+        it = iter_predictions(
+            images, model, batch_size=batch_size, nprocs=nprocs,
+            cache=cache)
+        for i, (image, pred) in enumerate(it):
+            Y_pred[i] = pred
             filename = os.path.split(image)[1]
             line = "%s\t%s\n" % (filename, categories[pred])
             write(line)
 
+        # compute accuracy
+        rfor_accuracy_score = accuracy_score(Y, Y_pred)
+        write("\nAccuracy score: %s\n" % rfor_accuracy_score)
+
     print "Results saved to '%s'." % results_file
 
     confmat = confusion_matrix(Y, Y_pred)
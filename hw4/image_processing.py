@@ -10,17 +10,36 @@ subdirectory the actual images.
 
 Running this script from the command line will load the images,
 perform some basic preprocessing (equalizing, scaling, etc.), and
-compute features. It will then save the feature array to a file called
-`image_dataset.npy`, and the categories to a file called
-`image_categories.npy` (these are both numpy files, and can be loaded
-by calling `np.load`).
+compute features. The features are saved, one image at a time, to a
+feature store in the directory `image_dataset/` (see
+`feature_store.py`), and the categories are saved to a file called
+`image_categories.npy` (a numpy file, which can be loaded by calling
+`np.load`). If the script is interrupted, running it again will
+resume from where it left off.
+
+Feature extraction is spread across a pool of worker processes (one
+per CPU by default). To use a specific number of processes, pass it
+as an argument:
+
+`python image_processing.py 4`
+
+With the `--fast` option, a cheaper preprocessing path is used (see
+`load_image`); its features are saved separately from the normal ones:
+
+`python image_processing.py --fast`
+
+Computed features are cached on disk (in `feature_cache/`), keyed by
+the contents of each image, so rerunning the script only computes
+features for new or modified images.
 
 """
 
 # built-in
+import multiprocessing
 import os
 import sys
 from glob import glob
+from itertools import imap
 # external
 import numpy as np
 import skimage.exposure
@@ -29,9 +48,43 @@ import skimage.filter
 import skimage.filter.rank
 import skimage.io
 import skimage.morphology
+import skimage.transform
+from PIL import Image
+# local
+from feature_cache import FeatureCache
+from feature_store import FeatureStore
+
+# parameters of the preprocessing and feature extraction. These are
+# recorded alongside saved features, so FEATURE_VERSION should be
+# incremented whenever the way features are computed changes.
+FEATURE_VERSION = 1
+IMAGE_SIZE = 400
+ENTROPY_RADIUS = 5
+
+# names of the features computed by `extract_features`
+FEATURE_NAMES = [
+    'mean_R', 'mean_G', 'mean_B',
+    'median_R', 'median_G', 'median_B',
+    'cov_RR', 'cov_RG', 'cov_RB',
+    'cov_GR', 'cov_GG', 'cov_GB',
+    'cov_BR', 'cov_BG', 'cov_BB',
+    'entropy_sum', 'entropy_mean', 'entropy_var'
+]
+
+
+def feature_version(fast=False):
+    """Get a string identifying the current feature extraction
+    parameters, e.g. 'v1-n400-r5', or 'v1-n400-r5-fast' when using
+    the fast preprocessing path (see `load_image`).
+
+    """
+    version = "v%d-n%d-r%d" % (FEATURE_VERSION, IMAGE_SIZE, ENTROPY_RADIUS)
+    if fast:
+        version += "-fast"
+    return version
 
 
-def load_image(img_path, n=400):
+def load_image(img_path, n=IMAGE_SIZE, fast=False):
     """Load an image from file, and perform minimal processing on it to
     prepare it for feature extraction.
 
@@ -43,18 +96,30 @@ def load_image(img_path, n=400):
         4) Denoise
         5) Resize
 
+    If `fast` is True, the image is instead resized first, so that
+    equalizing and (especially) denoising operate on the small image.
+    JPEGs are decoded directly at a reduced size where possible, and
+    the image is kept as float32. The resulting features are close
+    to, but not exactly the same as, the normal ones (use
+    `compare_preprocessing.py` to measure the difference).
+
     Parameters
     ----------
     img_path : string
         The path to the image
     n : int (optional)
         The size to scale the largest dimension to
+    fast : bool (optional)
+        Whether to use the fast preprocessing path
 
     Returns
     -------
     img : numpy.ndarray
 
     """
+    if fast:
+        return _load_image_fast(img_path, n)
+
     # load the image from file
     img = skimage.io.imread(img_path).astype('f8')
     # make sure it has three channels
@@ -75,6 +140,32 @@ def load_image(img_path, n=400):
     return img
 
 
+def _load_image_fast(img_path, n):
+    """Fast version of `load_image`, which resizes the image before
+    equalizing and denoising it.
+
+    """
+    # load the image from file, letting the JPEG decoder downscale it
+    # (by a power of two) as long as it stays larger than n
+    pil_img = Image.open(img_path)
+    pil_img.draft('RGB', (n, n))
+    # make sure it has three channels
+    pil_img = pil_img.convert('RGB')
+
+    # scale largest dimension to be of size n
+    scale = float(n) / max(pil_img.size)
+    size = tuple(int(round(x * scale)) for x in pil_img.size)
+    pil_img = pil_img.resize(size, Image.ANTIALIAS)
+    img = np.asarray(pil_img, dtype='f4')
+
+    # equalize histograms
+    img = skimage.exposure.equalize_hist(img).astype('f4')
+    # reduce noise
+    img = skimage.filter.denoise_bilateral(img, 3, 0.1).astype('f4')
+
+    return img
+
+
 def extract_features(img):
     """Extract a vector of features from an image. The feature vector is
     flat, but has the following components:
@@ -105,7 +196,7 @@ def extract_features(img):
     # (normalized) entropy of the grayscale image
     entropy = skimage.filter.rank.entropy(
         np.mean(img, axis=-1).astype('uint16'),
-        skimage.morphology.disk(5))
+        skimage.morphology.disk(ENTROPY_RADIUS))
     entropy = entropy / float(img.size)
     entropy_sum = np.sum(entropy)
     entropy_mean = np.mean(entropy)
@@ -118,6 +209,116 @@ def extract_features(img):
     return feature_vec
 
 
+def pad_images(imgs, n=IMAGE_SIZE):
+    """Stack images of different sizes (but whose largest dimension is
+    at most `n`, as returned by `load_image`) into a single array, by
+    padding each of them with zeros to be of size (n, n).
+
+    Parameters
+    ----------
+    imgs : list of numpy.ndarray
+        The (H, W, 3) images to stack
+    n : int (optional)
+        The size to pad each dimension to
+
+    Returns
+    -------
+    batch : (N, n, n, 3) numpy.ndarray
+        The padded images
+    shapes : (N, 2) numpy.ndarray
+        The original height and width of each image
+
+    """
+    batch = np.zeros((len(imgs), n, n, 3), dtype=imgs[0].dtype)
+    shapes = np.empty((len(imgs), 2), dtype='i8')
+    for i, img in enumerate(imgs):
+        h, w = img.shape[:2]
+        batch[i, :h, :w] = img
+        shapes[i] = (h, w)
+    return batch, shapes
+
+
+def extract_features_batch(imgs, shapes=None):
+    """Extract feature vectors (see `extract_features`) from a batch of
+    images at once. The channel means and covariances are computed for
+    all the images together (ignoring any padding); the medians (if the
+    images are different sizes) and the entropy filter are computed
+    separately for each image, on a view of its unpadded part.
+
+    Parameters
+    ----------
+    imgs : (N, H, W, 3) numpy.ndarray
+        The images to extract features from
+    shapes : (N, 2) numpy.ndarray (optional)
+        If the images have been padded (see `pad_images`), the height
+        and width of the unpadded part of each image. Padding is
+        ignored when computing features, so the result is the same as
+        calling `extract_features` on each unpadded image.
+
+    Returns
+    -------
+    features : (N, M) numpy.ndarray
+        Array of feature vectors, one row per image
+
+    """
+    N, H, W = imgs.shape[:3]
+    flat = imgs.reshape((N, H * W, 3)).astype('f8', copy=False)
+    if shapes is None:
+        mask = np.ones((N, 1, H * W))
+    else:
+        # mask out anything outside the unpadded part of each image, so
+        # it doesn't contribute to the sums below
+        rows = np.arange(H)[None, :, None] < shapes[:, 0, None, None]
+        cols = np.arange(W)[None, None, :] < shapes[:, 1, None, None]
+        mask = (rows & cols).reshape((N, 1, H * W)).astype('f8')
+        flat = flat * mask.reshape((N, H * W, 1))
+    count = mask.sum(axis=2)
+
+    # mean of each channel
+    mean = np.matmul(mask, flat)[:, 0] / count
+    # covariance between channels, computed from the sums of products
+    # of the channels of all images at once
+    prods = np.matmul(flat.transpose((0, 2, 1)), flat)
+    outer = mean[:, :, None] * mean[:, None, :]
+    cov = (prods - count[:, :, None] * outer) / (count - 1)[:, :, None]
+    cov = cov.reshape((N, 9))
+
+    # median of each channel
+    if shapes is None:
+        median = np.median(flat, axis=1)
+    else:
+        # the images are different sizes, so use the unpadded part of
+        # each image
+        median = np.empty((N, 3))
+        for i, (h, w) in enumerate(shapes):
+            median[i] = np.median(imgs[i, :h, :w].reshape((-1, 3)), axis=0)
+
+    # (normalized) entropy of the grayscale images
+    if shapes is None:
+        shapes = np.tile([H, W], (N, 1))
+    selem = skimage.morphology.disk(ENTROPY_RADIUS)
+    entropy_stats = np.empty((N, 3))
+    for i, (h, w) in enumerate(shapes):
+        gray = np.mean(imgs[i, :h, :w], axis=-1).astype('uint16')
+        entropy = skimage.filter.rank.entropy(gray, selem)
+        entropy = entropy / float(h * w * 3)
+        entropy_stats[i] = (
+            np.sum(entropy), np.mean(entropy), np.var(entropy))
+
+    # concatenate all the features together
+    features = np.hstack([mean, median, cov, entropy_stats])
+
+    return features
+
+
+def get_image_category(image_path):
+    """Get the name of the category of an image, i.e. the name of the
+    directory it is located in.
+
+    """
+    return os.path.split(os.path.split(image_path)[0])[1]
+
+
 def get_image_categories(images):
     """Get the true categories of a set of paths to images, based on the
     directory they are located in.
@@ -143,38 +344,145 @@ def get_image_categories(images):
         `categories` are indices into this list.
 
     """
-    get_category = lambda x: os.path.split(os.path.split(x)[0])[1]
-    categories = map(get_category, images)
+    categories = map(get_image_category, images)
     category_map = sorted(set(categories))
     categories = np.array(map(category_map.index, categories))
     return categories, category_map
 
 
-def load_and_extract(images):
+def _load_and_extract_one(args):
+    """Compute the feature vector of a single image, or load it from
+    the cache if it has already been computed. This needs to be a
+    module-level function so that it can be sent to worker processes.
+
+    Returns the cache key of the image (or None, if there is no
+    cache), the feature vector, and whether it was loaded from the
+    cache.
+
+    """
+    image_path, cache, fast = args
+    key = None
+    if cache is not None:
+        key = cache.key(image_path)
+        img_features = cache.load(key)
+        if img_features is not None:
+            return key, img_features, True
+    img = load_image(image_path, fast=fast)
+    return key, extract_features(img), False
+
+
+def iter_features(images, nprocs=1, chunksize=None, cache=None,
+                  fast=False):
+    """Load a list of images and compute the feature vector for each
+    of them, yielding the features as they are computed.
+
+    Parameters
+    ----------
+    images : list
+        List of paths to images
+    nprocs : int (optional)
+        Number of worker processes to use. If 1, the images are
+        processed serially in the current process; if None, one
+        process per CPU is used.
+    chunksize : int (optional)
+        Number of images to send to a worker process at a time. By
+        default, the images are split into about four chunks per
+        process.
+    cache : FeatureCache (optional)
+        If given, features are loaded from the cache when possible,
+        and newly computed features are saved to it. Its version
+        should match `fast` (see `feature_version`).
+    fast : bool (optional)
+        Whether to use the fast preprocessing path (see `load_image`)
+
+    Yields
+    ------
+    i : int
+        Index of the image in `images`
+    image_path : string
+        Path to the image
+    img_features : numpy.ndarray
+        One-dimensional numpy array of features
+
+    """
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+
+    # the images are looked up in the cache (which means hashing them)
+    # one at a time, by the same worker that would otherwise compute
+    # their features, so the first features are yielded without
+    # waiting for the whole list to be looked up
+    args = ((image_path, cache, fast) for image_path in images)
+
+    # imap returns results in the same order as the input, so the
+    # features come out in the same order as the serial version
+    pool = None
+    if nprocs > 1 and len(images) > 1:
+        if chunksize is None:
+            chunksize = max(1, len(images) / (4 * nprocs))
+        pool = multiprocessing.Pool(nprocs)
+        results = pool.imap(_load_and_extract_one, args, chunksize)
+    else:
+        results = imap(_load_and_extract_one, args)
+
+    num_cached = 0
+    try:
+        for i, image_path in enumerate(images):
+            # display progress
+            msg = "[%d / %d] %s" % (i, len(images), image_path)
+            sys.stdout.write(msg + "\r")
+            sys.stdout.flush()
+
+            # wait for the features to be loaded from the cache or
+            # computed, and save newly computed features to the cache
+            key, img_features, cached = results.next()
+            if cached:
+                cache.touch(key)
+                num_cached += 1
+            elif cache is not None:
+                cache.put(key, img_features)
+
+            # clear the output (the \r moves the cursor back to the
+            # beginning of the line, so we can overwrite it)
+            sys.stdout.write(" "*len(msg) + "\r")
+
+            yield i, image_path, img_features
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    if num_cached > 0:
+        print "Loaded %d / %d feature vectors from cache" % (
+            num_cached, len(images))
+
+
+def load_and_extract(images, nprocs=1, chunksize=None, cache=None,
+                     fast=False):
+    """Load a list of images and compute the feature vector for each
+    of them. See `iter_features` for a description of the parameters.
+
+    Returns
+    -------
+    features : (N, M) numpy.ndarray
+        Feature array, where N is the number of images and M is the
+        number of features. Rows are in the same order as `images`.
+
+    """
     # placeholder variable for feature array
     features = None
 
     # go through each image and calculate features, saving them in the
     # feature array
-    for i, image_path in enumerate(images):
-        # display progress
-        msg = "[%d / %d] %s" % (i, len(images), image_path)
-        sys.stdout.write(msg + "\r")
-        sys.stdout.flush()
-
-        # load and extract features
-        img = load_image(image_path)
-        img_features = extract_features(img)
-        if i == 0:
+    it = iter_features(
+        images, nprocs=nprocs, chunksize=chunksize, cache=cache, fast=fast)
+    for i, image_path, img_features in it:
+        if features is None:
             features = np.empty((len(images), img_features.size), dtype='f4')
-            sys.stdout.write(" "*len(msg) + "\r")
             print "Feature array has shape %s" % str(features.shape)
         features[i] = img_features
 
-        # clear the output (the \r moves the cursor back to the
-        # beginning of the line, so we can overwrite it)
-        sys.stdout.write(" "*len(msg) + "\r")
-
     return features
 
 
@@ -182,20 +490,42 @@ if __name__ == "__main__":
     # get the list of images
     images = glob("./50_categories/*/*.jpg")
 
-    # compute feature matrix
-    features = load_and_extract(images)
+    # whether to use the fast preprocessing path
+    args = sys.argv[1:]
+    fast = "--fast" in args
+    if fast:
+        args.remove("--fast")
+
+    # number of worker processes (defaults to one per CPU)
+    if len(args) > 0:
+        nprocs = int(args[0])
+    else:
+        nprocs = None
+
+    # open the feature store, and skip any images that are already in
+    # it (e.g. from a previous run that was interrupted)
+    if fast:
+        filename = "./image_dataset_fast"
+    else:
+        filename = "./image_dataset"
+    store = FeatureStore(filename, feature_version(fast=fast))
+    todo = [x for x in images if x not in store]
+    if len(todo) < len(images):
+        print "Resuming: %d / %d images already in '%s'" % (
+            len(images) - len(todo), len(images), filename)
 
     # create an integer mapping to categories
     categories, category_map = get_image_categories(images)
-
-    # concatenate the features (X) and categories (Y)
-    dataset = np.hstack([features, categories[:, None]])
-
-    # save to disk
-    filename = "./image_dataset.npy"
-    np.save(filename, dataset)
+    store.add_categories(category_map)
+
+    # compute features, saving each one to the store as soon as it is
+    # computed
+    cache = FeatureCache(feature_version(fast=fast))
+    it = iter_features(todo, nprocs=nprocs, cache=cache, fast=fast)
+    for i, image_path, img_features in it:
+        store.append(image_path, get_image_category(image_path), img_features)
     print "Saved features to '%s'" % filename
 
     filename = "./image_categories.npy"
-    np.save(filename, category_map)
+    np.save(filename, store.category_map)
     print "Saved categories to '%s'" % filename
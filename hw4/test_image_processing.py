@@ -0,0 +1,47 @@
+"""Tests for image_processing.py
+
+Run with `nosetests` (or `py.test`) from this directory.
+
+"""
+
+# external
+import numpy as np
+# local
+from image_processing import extract_features, extract_features_batch
+from image_processing import pad_images
+
+
+def make_images(shapes, seed=0):
+    """Generate random images (with values in [0, 255], like the
+    output of `load_image`) of the given heights and widths.
+
+    """
+    rso = np.random.RandomState(seed)
+    return [rso.rand(h, w, 3) * 255 for h, w in shapes]
+
+
+def test_extract_features_batch_padded():
+    imgs = make_images([(40, 30), (25, 40), (40, 40), (13, 7)])
+    features = extract_features_batch(*pad_images(imgs, n=40))
+    expected = np.array([extract_features(img) for img in imgs])
+    assert features.shape == expected.shape
+    assert np.allclose(features, expected, rtol=1e-10, atol=0)
+
+
+def test_extract_features_batch_same_size():
+    imgs = make_images([(32, 24)] * 3)
+    features = extract_features_batch(np.array(imgs))
+    expected = np.array([extract_features(img) for img in imgs])
+    assert features.shape == expected.shape
+    assert np.allclose(features, expected, rtol=1e-10, atol=0)
+
+
+def test_pad_images():
+    imgs = make_images([(5, 3), (2, 4)])
+    batch, shapes = pad_images(imgs, n=5)
+    assert batch.shape == (2, 5, 5, 3)
+    assert (shapes == [[5, 3], [2, 4]]).all()
+    assert (batch[0, :, :3] == imgs[0]).all()
+    assert (batch[0, :, 3:] == 0).all()
+    assert (batch[1, :2, :4] == imgs[1]).all()
+    assert (batch[1, 2:] == 0).all()
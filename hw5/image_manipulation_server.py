@@ -1,27 +1,78 @@
+import hashlib
+import itertools
+import json
 import os
 import numpy as np
+import Queue
+import random
+import socket
 import StringIO
+import sys
+import threading
+import time
 import xmlrpclib
 
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from PIL import Image
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 
 
-def encode(image):
+# wire formats that images can be sent in. "raw" is the array itself,
+# preceded by a header line giving its dtype and shape, e.g.
+# "ndarray uint8 480,640,3\n"
+FORMATS = ("jpeg", "png", "raw")
+RAW_MAGIC = "ndarray "
+
+
+def wire_format(binary):
+    """Determine the format (one of FORMATS) of an encoded image.
+
+    Parameters
+    ----------
+    binary : xmlrpclib.Binary instance
+
+    Returns
+    -------
+    string
+
+    """
+    data = binary.data
+    if data.startswith(RAW_MAGIC):
+        return "raw"
+    elif data.startswith("\x89PNG"):
+        return "png"
+    elif data.startswith("\xff\xd8"):
+        return "jpeg"
+    raise ValueError("unknown image format")
+
+
+def encode(image, format="jpeg"):
     """Encode an image to XML-RPC base-64 encoding.
 
     Parameters
     ----------
     image : np.ndarray
+    format : string (optional)
+        One of FORMATS. Only "jpeg" is lossy; "raw" avoids compressing
+        the image at all.
 
     Returns
     -------
     xmlrpclib.Binary instance
 
     """
+    if format == "raw":
+        image = np.ascontiguousarray(image)
+        header = "%s%s %s\n" % (
+            RAW_MAGIC, image.dtype.str, ",".join(map(str, image.shape)))
+        return xmlrpclib.Binary(header + image.tostring())
+    elif format not in FORMATS:
+        raise ValueError("unknown image format: %s" % format)
+
     # save the image into a string buffer
     strio = StringIO.StringIO()
-    Image.fromarray(image).save(strio, format="jpeg")
+    Image.fromarray(image).save(strio, format=format)
     # read out the string from the buffer
     strio.seek(0)
     imstr = strio.read()
@@ -31,7 +82,8 @@ def encode(image):
 
 
 def decode(binary):
-    """Decode an image from XML-RPC base-64 encoding to an array.
+    """Decode an image from XML-RPC base-64 encoding to an array. Raw
+    images are not copied, so the returned array is read-only.
 
     Parameters
     ----------
@@ -42,27 +94,390 @@ def decode(binary):
     numpy.ndarray
 
     """
+    if wire_format(binary) == "raw":
+        # parse the header, and then view the rest of the data as an
+        # array
+        header_len = binary.data.index("\n") + 1
+        dtype, shape = binary.data[len(RAW_MAGIC):header_len - 1].split()
+        shape = tuple(int(x) for x in shape.split(","))
+        image = np.frombuffer(binary.data, dtype=dtype, offset=header_len)
+        return image.reshape(shape)
+
     # create a string buffer from the string (binary data)
     strio = StringIO.StringIO(binary.data)
     # create a PIL image from that string and then convert it to a
     # numpy array
     image = Image.open(strio)
-    image = np.asarray(image).copy()
+    image = np.asarray(image)
     strio.close()
     return image
 
 
+class ServerStats(object):
+    """Per-method statistics about requests: the number of calls and
+    cache hits, the number of bytes received and sent, and histograms
+    of how long each phase of a request (decode, compute, encode, and
+    saving the audit images) took.
+
+    """
+
+    # upper bounds (in seconds) of the latency histogram buckets; the
+    # last bucket holds everything slower than the last bound
+    bounds = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.,
+              2., 5.]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear all statistics."""
+        with self.lock:
+            self.started = time.time()
+            self.calls = defaultdict(int)
+            self.cache_hits = defaultdict(int)
+            self.bytes_in = defaultdict(int)
+            self.bytes_out = defaultdict(int)
+            self.phases = defaultdict(dict)
+
+    def record(self, method, phase, seconds):
+        """Record how long a phase of a request took."""
+        bucket = np.searchsorted(self.bounds, seconds)
+        with self.lock:
+            if phase not in self.phases[method]:
+                self.phases[method][phase] = {
+                    'count': 0,
+                    'total': 0.,
+                    'max': 0.,
+                    'histogram': [0] * (len(self.bounds) + 1)
+                }
+            hist = self.phases[method][phase]
+            hist['count'] += 1
+            hist['total'] += seconds
+            hist['max'] = max(hist['max'], seconds)
+            hist['histogram'][bucket] += 1
+
+    @contextmanager
+    def timer(self, method, phase):
+        """Context manager which records how long its body takes."""
+        start = time.time()
+        yield
+        self.record(method, phase, time.time() - start)
+
+    def count(self, method, bytes_in, bytes_out, cache_hit=False):
+        """Record a completed request."""
+        with self.lock:
+            self.calls[method] += 1
+            self.bytes_in[method] += bytes_in
+            self.bytes_out[method] += bytes_out
+            if cache_hit:
+                self.cache_hits[method] += 1
+
+    def snapshot(self):
+        """Get all statistics, as a dictionary (of basic types, so it
+        can be sent over XML-RPC or saved as JSON).
+
+        """
+        with self.lock:
+            methods = {}
+            for method in set(self.calls) | set(self.phases):
+                phases = {}
+                for phase, hist in self.phases[method].items():
+                    phases[phase] = dict(hist)
+                    phases[phase]['histogram'] = list(hist['histogram'])
+                methods[method] = {
+                    'calls': self.calls[method],
+                    'cache_hits': self.cache_hits[method],
+                    # floats, because XML-RPC integers are only 32 bits
+                    'bytes_in': float(self.bytes_in[method]),
+                    'bytes_out': float(self.bytes_out[method]),
+                    'phases': phases
+                }
+            return {
+                'uptime': time.time() - self.started,
+                'bounds': list(self.bounds),
+                'methods': methods
+            }
+
+    def start_dump(self, filename, interval=60):
+        """Start a thread which saves a snapshot of the statistics (as
+        JSON) to `filename` every `interval` seconds.
+
+        """
+        def dump():
+            while True:
+                time.sleep(interval)
+                # write to a temporary file and then move it into
+                # place, so the file is never partially written
+                with open(filename + ".tmp", "w") as fh:
+                    json.dump(self.snapshot(), fh, indent=2)
+                os.rename(filename + ".tmp", filename)
+
+        dumper = threading.Thread(target=dump)
+        dumper.daemon = True
+        dumper.start()
+
+
+class SamplingProfiler(object):
+    """A statistical profiler which periodically records which line of
+    code each thread that is processing an image is running. It is
+    off until `start` is called, and can be turned on and off while
+    the server is running.
+
+    Parameters
+    ----------
+    interval : float (optional)
+        Time between samples, in seconds
+
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = defaultdict(int)
+        self.threads = set()
+        self.lock = threading.Lock()
+        # the sampling thread, and the event used to stop it
+        self.sampler = None
+        self.stopped = None
+        self.control_lock = threading.Lock()
+
+    @property
+    def running(self):
+        """Whether the profiler is currently sampling."""
+        return self.sampler is not None
+
+    @contextmanager
+    def active(self):
+        """Context manager which marks the current thread as one that
+        should be sampled.
+
+        """
+        ident = threading.current_thread().ident
+        self.threads.add(ident)
+        try:
+            yield
+        finally:
+            self.threads.discard(ident)
+
+    def sample(self, stopped):
+        """Take samples until `stopped` (a `threading.Event`) is set."""
+        while not stopped.is_set():
+            frames = sys._current_frames()
+            with self.lock:
+                for ident in list(self.threads):
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    code = frame.f_code
+                    location = "%s:%d(%s)" % (
+                        code.co_filename, frame.f_lineno, code.co_name)
+                    self.samples[location] += 1
+            stopped.wait(self.interval)
+
+    def start(self):
+        """Start sampling."""
+        with self.control_lock:
+            if self.sampler is not None:
+                return
+            self.stopped = threading.Event()
+            self.sampler = threading.Thread(
+                target=self.sample, args=(self.stopped,))
+            self.sampler.daemon = True
+            self.sampler.start()
+
+    def stop(self):
+        """Stop sampling (the samples collected so far are kept). Waits
+        for the sampling thread to exit, so that it is never running
+        at the same time as one started by a later call to `start`.
+
+        """
+        with self.control_lock:
+            if self.sampler is None:
+                return
+            self.stopped.set()
+            self.sampler.join()
+            self.sampler = None
+            self.stopped = None
+
+    def set_profiling(self, enabled):
+        """Turn the profiler on or off. Returns whether it is on."""
+        if enabled:
+            self.start()
+        else:
+            self.stop()
+        return self.running
+
+    def top(self, n=20):
+        """Get the `n` most frequently sampled lines of code, as a list
+        of [location, number of samples] pairs.
+
+        """
+        with self.lock:
+            samples = sorted(
+                self.samples.items(), key=lambda x: x[1], reverse=True)
+        return [list(x) for x in samples[:n]]
+
+    def reset(self):
+        """Discard all samples."""
+        with self.lock:
+            self.samples.clear()
+        return True
+
+
+# the statistics and profiler for the image manipulation methods
+stats = ServerStats()
+profiler = SamplingProfiler()
+
+
+class ResultCache(object):
+    """A least-recently-used cache of encoded results. Because all of
+    the image manipulations are pure functions of their input, a
+    request whose result is in the cache doesn't need to be decoded,
+    computed, or encoded at all.
+
+    Parameters
+    ----------
+    max_bytes : int (optional)
+        Maximum total size of the cached results. When it is exceeded,
+        the least recently used results are evicted.
+
+    """
+
+    def __init__(self, max_bytes=2**27):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """Whether results are cached at all (`max_bytes` is 0 to
+        disable the cache).
+
+        """
+        return self.max_bytes > 0
+
+    def key(self, name, data, *args):
+        """Compute the cache key for a call to method `name` with the
+        encoded image `data` and any other arguments.
+
+        """
+        return (name, hashlib.sha1(data.data).hexdigest()) + args
+
+    def get(self, key):
+        """Get a cached result, or None if it is not in the cache."""
+        with self.lock:
+            result = self.entries.pop(key, None)
+            if result is None:
+                self.misses += 1
+                return None
+            # move it to the end, since it is now the most recently
+            # used result
+            self.entries[key] = result
+            self.hits += 1
+            return result
+
+    def put(self, key, result):
+        """Add a result to the cache, evicting the least recently used
+        results if necessary.
+
+        """
+        size = len(result.data)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old.data)
+            self.entries[key] = result
+            self.size += size
+            while self.size > self.max_bytes:
+                old_key, old = self.entries.popitem(last=False)
+                self.size -= len(old.data)
+
+    def info(self):
+        """Get statistics about the result cache: the number of hits
+        and misses, and the number and total size of cached results.
+
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+            }
+
+
+# the cache used by `process_image`
+result_cache = ResultCache()
+
+
+def process_image(name, data, format, func, *key_args):
+    """Decode an image, apply a function to it, and encode the result,
+    unless the result is already cached. Records statistics about each
+    phase of the request.
+
+    Parameters
+    ----------
+    name : string
+        Name of the method being called
+    data : xmlrpclib.Binary instance
+        The encoded input image
+    format : string
+        Format to encode the output in (see FORMATS), or None to use
+        the same format as the input
+    func : function
+        Function taking an image array and returning a new one
+    key_args : strings
+        Any other arguments that the result depends on
+
+    Returns
+    -------
+    xmlrpclib.Binary instance
+
+    """
+    with profiler.active():
+        if format is None:
+            format = wire_format(data)
+        # don't hash the image if the cache is disabled
+        result = key = None
+        if result_cache.enabled:
+            key = result_cache.key(name, data, format, *key_args)
+            result = result_cache.get(key)
+        cache_hit = result is not None
+
+        if not cache_hit:
+            with stats.timer(name, "decode"):
+                image = decode(data)
+            with stats.timer(name, "compute"):
+                new_image = func(image)
+            with stats.timer(name, "encode"):
+                result = encode(new_image, format=format)
+            if key is not None:
+                result_cache.put(key, result)
+
+    stats.count(name, len(data.data), len(result.data), cache_hit=cache_hit)
+    return result
+
+
 def serializable(func):
-    """Helper decorator which encodes the input image as a numpy array,
-    passes the encoded image to the function, and decodes the output
+    """Helper decorator which decodes the input image to a numpy array,
+    passes the decoded image to the function, and encodes the output
     back to a serialized format.
 
+    The output is encoded in the same format as the input, unless the
+    caller asks for a different one (see FORMATS). Results are cached
+    (see ResultCache), so repeated requests are only computed once.
+
     """
 
-    def code_image(self, data):
-        image = decode(data)
-        new_image = func(self, image)
-        return encode(new_image)
+    def code_image(self, data, format=None):
+        return process_image(
+            func.__name__, data, format, lambda image: func(self, image))
 
     # ensure that the decorated function has the same name and
     # docstring as the original function
@@ -71,6 +486,9 @@ def serializable(func):
     Parameters
     ----------
     image : xmlrpclib.Binary object
+    format : string (optional)
+        Format to encode the result in: "jpeg", "png", or "raw"
+        (defaults to the format of the input image)
 
     Returns
     -------
@@ -78,35 +496,147 @@ def serializable(func):
 
     """
     code_image.__name__ = func.__name__
+    code_image.undecorated = getattr(func, "undecorated", func)
     return code_image
 
 
+class AuditLog(object):
+    """Saves the input and output images of requests to disk in a
+    background thread, so that requests don't have to wait for the
+    images to be written.
+
+    Each pair of images gets a unique filename, of the form
+    `<name>_<timestamp>_<number>_in.jpg` (and `_out.jpg`).
+
+    Parameters
+    ----------
+    path : string (optional)
+        Directory to save the images to
+    rate : float (optional)
+        Fraction of requests to save the images of
+    max_bytes : int (optional)
+        Once the directory contains this many bytes, no more images
+        are saved (this is checked before each pair of images is
+        written, so it is exceeded by at most one pair)
+    max_queue : int (optional)
+        Maximum number of requests waiting to be saved; if the writer
+        falls further behind than this, images are dropped
+
+    """
+
+    def __init__(self, path="server_images", rate=1.0, max_bytes=2**30,
+                 max_queue=64):
+        self.path = path
+        self.rate = rate
+        self.max_bytes = max_bytes
+        self.max_queue = max_queue
+
+        self.counter = itertools.count()
+        self.dropped = 0
+        self.size = None
+        self.queue = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the writer thread, if it hasn't been started yet."""
+        with self.lock:
+            if self.queue is not None:
+                return
+
+            # make the image directory if it does not exist
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            # find out how much space is already used
+            self.size = sum(
+                os.path.getsize(os.path.join(self.path, x))
+                for x in os.listdir(self.path))
+
+            self.queue = Queue.Queue(self.max_queue)
+            writer = threading.Thread(target=self.write_worker)
+            writer.daemon = True
+            writer.start()
+
+    def save(self, name, image, new_image):
+        """Queue the input and output images of a request to be saved.
+        This returns immediately.
+
+        """
+        if random.random() >= self.rate:
+            return
+        self.start()
+        if self.full():
+            return
+
+        prefix = "%s_%s_%06d" % (
+            name, time.strftime("%Y%m%d-%H%M%S"), next(self.counter))
+        try:
+            self.queue.put_nowait((name, prefix, image, new_image))
+        except Queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def full(self):
+        """Check whether the directory has reached `max_bytes`, and if
+        so, count the images as dropped.
+
+        """
+        with self.lock:
+            if self.size < self.max_bytes:
+                return False
+            self.dropped += 1
+            return True
+
+    def write_worker(self):
+        """Save queued images to disk, forever."""
+        while True:
+            name, prefix, image, new_image = self.queue.get()
+            try:
+                # the directory may have filled up while these images
+                # were waiting in the queue
+                if self.full():
+                    continue
+                start = time.time()
+                for suffix, img in [("in", image), ("out", new_image)]:
+                    filename = os.path.join(
+                        self.path, "%s_%s.jpg" % (prefix, suffix))
+                    Image.fromarray(img).save(filename)
+                    size = os.path.getsize(filename)
+                    with self.lock:
+                        self.size += size
+                stats.record(name, "save", time.time() - start)
+            except Exception as err:
+                print "Could not save %s: %s" % (prefix, err)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        """Wait until all queued images have been saved."""
+        if self.queue is not None:
+            self.queue.join()
+
+
+# the audit log used by `save_images`
+audit_log = AuditLog()
+
+
 def save_images(func):
     """Helper decorator which saves the input and output images of a
-    function.
+    function (in the background, see AuditLog).
 
     """
 
-    # make the image directory if it does not exist
-    if not os.path.exists("server_images"):
-        os.makedirs("server_images")
-
-    def save(self, image):
+    def save(self, image, *args):
         # call the function
-        new_image = func(self, image)
-        # get the name of the function
-        name = func.__name__
-        # save the input and output images to disk
-        Image.fromarray(image).save(
-            "server_images/%s_in.jpg" % name)
-        Image.fromarray(new_image).save(
-            "server_images/%s_out.jpg" % name)
+        new_image = func(self, image, *args)
+        # queue the input and output images to be saved to disk
+        audit_log.save(func.__name__.lstrip("_"), image, new_image)
         return new_image
 
     # ensure that the decorated function has the same name and
     # docstring as the original function
     save.__doc__ = func.__doc__
     save.__name__ = func.__name__
+    save.undecorated = func
     return save
 
 
@@ -119,8 +649,19 @@ class ImageManipulations(object):
         * rotate_counterclockwise
         * rotate_clockwise
 
+    Several of these can be applied in one call with `pipeline`.
+
     """
 
+    # the operations which can be used in a pipeline
+    operations = (
+        "invert",
+        "flip_vertical",
+        "flip_horizontal",
+        "rotate_counterclockwise",
+        "rotate_clockwise",
+    )
+
     @serializable
     @save_images
     def invert(self, image):
@@ -151,22 +692,225 @@ class ImageManipulations(object):
         """Rotate an image 90 degrees clockwise."""
         return image.swapaxes(0, 1)[:, ::-1]
 
+    def pipeline(self, data, operations, format=None):
+        """Apply a sequence of operations to an image, e.g.
+        ["rotate_clockwise", "invert"]. The image is only decoded and
+        encoded once.
+
+        Parameters
+        ----------
+        image : xmlrpclib.Binary object
+        operations : list of strings
+            Names of the operations to apply, in order
+        format : string (optional)
+            Format to encode the result in: "jpeg", "png", or "raw"
+            (defaults to the format of the input image)
+
+        Returns
+        -------
+        xmlrpclib.Binary object
+
+        """
+        return process_image(
+            "pipeline", data, format,
+            lambda image: self._pipeline(image, operations),
+            ",".join(map(str, operations)))
+
+    @save_images
+    def _pipeline(self, image, operations):
+        for name in operations:
+            if name not in self.operations:
+                raise ValueError("unknown operation: %s" % name)
+
+        # the flips and rotations just return a view of the image, so
+        # applying them in sequence results in a single strided view
+        # without copying. Inverting commutes with all of them, and
+        # inverting twice does nothing, so it is only applied (at
+        # most) once, at the end.
+        invert = False
+        for name in operations:
+            if name == "invert":
+                invert = not invert
+            else:
+                op = getattr(self, name).undecorated
+                image = op(self, image)
+
+        if invert:
+            image = 255 - image
+        return image
+
+
+class ThreadPoolMixIn(object):
+    """Mix-in class which handles requests in a fixed-size pool of
+    worker threads, rather than one at a time (like the default
+    server) or in a new thread per request (like ThreadingMixIn).
+
+    Accepted requests wait in a queue until a worker is free. If the
+    queue is full, the request is rejected with an HTTP 503 (Service
+    Unavailable) response, which xmlrpclib clients see as a
+    ProtocolError, so they can back off and retry. Rejected requests
+    are handed to a separate thread, which reads (and discards) the
+    request before sending the response; otherwise, a client that is
+    still uploading a large request would have its connection reset
+    rather than receiving the response. If that thread also falls too
+    far behind, connections are closed without a response.
+
+    """
 
-class ImageManipulationServer(SimpleXMLRPCServer):
+    # number of worker threads
+    nthreads = 8
+    # maximum number of requests waiting for a worker (must be at least
+    # 1, since a Queue of size 0 would be unbounded)
+    max_queue = 64
+    # maximum number of rejected requests waiting to be drained
+    max_rejected = 64
+    # how long (in seconds) to wait for a rejected client to send its
+    # request
+    reject_timeout = 10
+
+    busy_response = (
+        "HTTP/1.0 503 Service Unavailable\r\n"
+        "Content-Type: text/plain\r\n"
+        "Content-Length: 12\r\n"
+        "Retry-After: 1\r\n"
+        "\r\n"
+        "Server busy\n")
+
+    def start_workers(self):
+        """Create the request queues and start the worker threads."""
+        if self.nthreads < 1:
+            raise ValueError("nthreads must be at least 1")
+        if self.max_queue < 1:
+            raise ValueError("max_queue must be at least 1")
+
+        self.request_queue = Queue.Queue(self.max_queue)
+        self.workers = []
+        for i in xrange(self.nthreads):
+            worker = threading.Thread(target=self.process_request_worker)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+        self.reject_queue = Queue.Queue(self.max_rejected)
+        rejecter = threading.Thread(target=self.reject_request_worker)
+        rejecter.daemon = True
+        rejecter.start()
+
+    def process_request_worker(self):
+        """Handle requests from the queue, forever."""
+        while True:
+            request, client_address = self.request_queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def reject_request_worker(self):
+        """Reject requests from the reject queue, forever."""
+        while True:
+            request = self.reject_queue.get()
+            try:
+                self.reject_request(request)
+            except (socket.error, ValueError):
+                pass
+            finally:
+                self.shutdown_request(request)
+
+    def reject_request(self, request):
+        """Read the headers and body of a request, and then send the
+        busy response.
+
+        """
+        request.settimeout(self.reject_timeout)
+        rfile = request.makefile('rb', -1)
+        length = 0
+        while True:
+            line = rfile.readline(65537)
+            if line in ("", "\r\n", "\n"):
+                break
+            name, sep, value = line.partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+        while length > 0:
+            chunk = rfile.read(min(length, 65536))
+            if not chunk:
+                break
+            length -= len(chunk)
+        rfile.close()
+        request.sendall(self.busy_response)
+
+    def process_request(self, request, client_address):
+        """Queue a request to be handled by a worker thread, or reject
+        it if the queue is full.
+
+        """
+        try:
+            self.request_queue.put_nowait((request, client_address))
+        except Queue.Full:
+            try:
+                self.reject_queue.put_nowait(request)
+            except Queue.Full:
+                self.shutdown_request(request)
+
+
+class ImageManipulationServer(ThreadPoolMixIn, SimpleXMLRPCServer):
     """A simple subclass of SimpleXMLRPCServer that registers the
     appropriate image manipulation functions (see the
     ImageManipulations class).
 
+    Requests are handled concurrently by a pool of `nthreads` worker
+    threads; at most `max_queue` (at least 1) requests can wait for a
+    free worker before new requests are rejected (see
+    ThreadPoolMixIn).
+
+    A fraction `audit_rate` of the requests have their input and
+    output images saved to the 'server_images' directory, until it
+    reaches `audit_max_bytes` bytes (see AuditLog).
+
+    Up to `cache_max_bytes` bytes of results are cached (see
+    ResultCache); if it is 0, the cache is turned off, and images are
+    not hashed at all. Statistics about the cache can be retrieved by
+    calling `system.cacheInfo`.
+
+    Per-method statistics (see ServerStats) can be retrieved by calling
+    `system.stats`; if `stats_file` is given, they are also saved
+    there every `stats_interval` seconds. The sampling profiler (see
+    SamplingProfiler) is turned on or off by calling
+    `system.setProfiling`, and its results retrieved by calling
+    `system.profile`.
+
     """
 
-    def __init__(self, host="127.0.0.1", port=5021):
+    def __init__(self, host="127.0.0.1", port=5021, nthreads=8,
+                 max_queue=64, audit_rate=1.0, audit_max_bytes=2**30,
+                 cache_max_bytes=2**27, stats_file=None, stats_interval=60):
+        # start the worker threads first, so that invalid arguments are
+        # reported before the port is bound
+        self.nthreads = nthreads
+        self.max_queue = max_queue
+        self.start_workers()
+
         SimpleXMLRPCServer.__init__(self, (host, port), allow_none=True)
 
         self.register_instance(ImageManipulations())
         self.register_multicall_functions()
         self.register_introspection_functions()
-
-        print "Started XML-RPC server at %s:%d" % (host, port)
+        self.register_function(result_cache.info, "system.cacheInfo")
+        self.register_function(stats.snapshot, "system.stats")
+        self.register_function(profiler.set_profiling, "system.setProfiling")
+        self.register_function(profiler.top, "system.profile")
+        self.register_function(profiler.reset, "system.resetProfile")
+
+        audit_log.rate = audit_rate
+        audit_log.max_bytes = audit_max_bytes
+        result_cache.max_bytes = cache_max_bytes
+        if stats_file is not None:
+            stats.start_dump(stats_file, stats_interval)
+
+        print "Started XML-RPC server at %s:%d (%d threads)" % (
+            host, port, nthreads)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+"""Load test for the image manipulation server
+
+Sends requests to the server from several concurrent clients, and
+reports the throughput (requests per second) and the median and 99th
+percentile latency, for 1, 8 and 64 concurrent clients.
+
+To test a server that is already running:
+
+`python load_test.py 127.0.0.1:5021`
+
+If no address is given, a server is started in a separate process on
+port 5022 for the duration of the test, with its result cache turned
+off. Every request sends the same image, so with the cache on, all but
+the first request would be cache hits, and the test would not measure
+decoding, computing and encoding the image at all. When testing a
+server that is already running, it should be started with
+`cache_max_bytes=0`; the number of cache hits during each test is
+reported, so that this can be checked.
+
+"""
+
+# built-in
+import multiprocessing
+import socket
+import sys
+import threading
+import time
+from xmlrpclib import ProtocolError, ServerProxy
+# external
+import numpy as np
+# local
+from image_manipulation_server import ImageManipulationServer, encode
+
+
+def run_client(url, method, data, nrequests, latencies, errors):
+    """Make `nrequests` calls to `method` on the server, appending the
+    latency of each successful call to `latencies`, and counting
+    failed calls in `errors`.
+
+    """
+    func = getattr(ServerProxy(url), method)
+    for i in xrange(nrequests):
+        start = time.time()
+        try:
+            func(data)
+        except ProtocolError as err:
+            if err.errcode == 503:
+                errors.append('busy')
+            else:
+                errors.append('error')
+        except socket.error:
+            errors.append('error')
+        else:
+            latencies.append(time.time() - start)
+
+
+def load_test(url, nclients, nrequests, data, method="invert"):
+    """Run a load test with `nclients` concurrent clients, each making
+    `nrequests` requests.
+
+    Returns
+    -------
+    dict with keys: clients, requests, time, requests_per_s, p50, p99,
+    busy, errors
+
+    """
+    latencies = []
+    errors = []
+    threads = [
+        threading.Thread(
+            target=run_client,
+            args=(url, method, data, nrequests, latencies, errors))
+        for i in xrange(nclients)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    if latencies:
+        p50, p99 = np.percentile(latencies, [50, 99])
+    else:
+        p50 = p99 = np.nan
+
+    return {
+        'clients': nclients,
+        'requests': len(latencies),
+        'time': elapsed,
+        'requests_per_s': len(latencies) / elapsed,
+        'p50': p50,
+        'p99': p99,
+        'busy': errors.count('busy'),
+        'errors': errors.count('error'),
+    }
+
+
+def serve(port):
+    server = ImageManipulationServer(port=port, cache_max_bytes=0)
+    server.serve_forever()
+
+
+def cache_hits(url):
+    """Get the number of result cache hits so far on the server."""
+    return ServerProxy(url).system.cacheInfo()['hits']
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        address = sys.argv[1]
+        server = None
+    else:
+        address = "127.0.0.1:5022"
+        server = multiprocessing.Process(target=serve, args=(5022,))
+        server.daemon = True
+        server.start()
+        time.sleep(1)
+
+    url = "http://%s" % address
+    rso = np.random.RandomState(0)
+    image = (rso.rand(512, 512, 3) * 255).astype('uint8')
+    data = encode(image)
+
+    try:
+        print "%8s %10s %10s %10s %10s %6s %6s %6s" % (
+            "clients", "requests", "req/s", "p50 (ms)", "p99 (ms)",
+            "busy", "errors", "cached")
+        for nclients in [1, 8, 64]:
+            # keep the total number of requests roughly constant
+            nrequests = max(2, 256 / nclients)
+            hits = cache_hits(url)
+            result = load_test(url, nclients, nrequests, data)
+            hits = cache_hits(url) - hits
+            print "%8d %10d %10.1f %10.1f %10.1f %6d %6d %6d" % (
+                result['clients'], result['requests'],
+                result['requests_per_s'], result['p50'] * 1000,
+                result['p99'] * 1000, result['busy'], result['errors'],
+                hits)
+
+    finally:
+        if server is not None:
+            server.terminate()
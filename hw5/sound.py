@@ -1,9 +1,25 @@
+# built-in
+import csv
+import multiprocessing
+import os
+import sys
+import time
+from itertools import imap
+# external
 from scikits.audiolab import Sndfile
 import numpy as np
 import matplotlib.pyplot as plt
 
 NOTES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
 
+# window functions for `spectrogram`
+WINDOWS = {
+    "hann": np.hanning,
+    "hamming": np.hamming,
+    "blackman": np.blackman,
+    "boxcar": np.ones,
+}
+
 
 def load(filename):
     """Load an audio file and average over channels. Returns the data as a
@@ -18,6 +34,28 @@ def load(filename):
     return data, rate
 
 
+def iter_blocks(filename, blocksize=10000):
+    """Read an audio file in blocks of `blocksize` frames, averaging
+    over channels. Yields the blocks as numpy arrays (the last block
+    may be shorter), so only one block is in memory at a time. The
+    file is closed when the generator is exhausted or closed. The
+    sampling rate can be found with `Sndfile(filename).samplerate`.
+
+    """
+    fh = Sndfile(filename, "r")
+    try:
+        remaining = fh.nframes
+        while remaining > 0:
+            data = fh.read_frames(min(blocksize, remaining))
+            remaining -= data.shape[0]
+            if data.ndim == 2:
+                data = np.mean(data, axis=-1)
+            yield data
+    finally:
+        # also runs if the generator is closed before it is exhausted
+        fh.close()
+
+
 def plot_amplitude(data, rate):
     """Plot time vs. amplitude of an audio signal."""
     time = np.arange(data.size) / float(rate)
@@ -29,9 +67,17 @@ def plot_amplitude(data, rate):
     ax1.set_xlim(min(time), max(time))
 
 
-def freq_power(data, rate):
-    """Compute the frequency and power spectrum of an audio signal."""
-    n = 10000
+def freq_power(data, rate, n=10000, average=False):
+    """Compute the frequency and power spectrum of an audio signal. By
+    default, only the first `n` samples are used; if `average` is
+    True, the power spectra of all consecutive blocks of `n` samples
+    are averaged instead (see `freq_power_stream`).
+
+    """
+    if average:
+        return freq_power_stream(
+            (data[i:i+n] for i in xrange(0, data.size, n)), rate, n=n)
+
     fft = np.fft.fft(data, n)[1:n/2]
     power = np.abs(fft) ** 2
     freq = rate * np.fft.fftfreq(n)[1:n/2]
@@ -39,6 +85,70 @@ def freq_power(data, rate):
     return freq, power
 
 
+def freq_power_stream(blocks, rate, n=10000):
+    """Compute the frequency and average power spectrum of an audio
+    signal given as an iterable of blocks of (at most) `n` samples,
+    e.g. from `iter_blocks`. The blocks are processed one at a time,
+    so memory use doesn't depend on the length of the signal. Raises a
+    ValueError if there are no blocks (e.g. for an empty file).
+
+    A block that is shorter than `n` samples is zero-padded, so its
+    power is proportionally smaller; the spectra are therefore summed
+    and divided by the number of samples (in units of `n`), rather
+    than by the number of blocks.
+
+    """
+    total = None
+    samples = 0
+    for block in blocks:
+        freq, power = freq_power(block, rate, n=n)
+        if total is None:
+            total = power
+        else:
+            total += power
+        samples += min(len(block), n)
+
+    if samples == 0:
+        raise ValueError("no audio data")
+    return freq, total * (float(n) / samples)
+
+
+def spectrogram(data, rate, n=4096, hop=None, window="hann"):
+    """Compute the short-time power spectrum of an audio signal, using
+    overlapping windows of `n` samples that start every `hop` samples
+    (by default, n / 2). `window` can be the name of one of WINDOWS,
+    or an array of length `n`. Returns the
+    frequencies, the time at the center of each window, and the power
+    spectrum of each window as a float32 array of shape (frames,
+    frequencies).
+
+    """
+    if hop is None:
+        hop = n / 2
+    if isinstance(window, str):
+        window = WINDOWS[window](n)
+
+    # make sure there is at least one full window
+    data = np.asarray(data, dtype='f8')
+    if data.size < n:
+        data = np.concatenate([data, np.zeros(n - data.size)])
+
+    # view the signal as overlapping frames, without copying it
+    nframes = 1 + (data.size - n) / hop
+    stride = data.strides[0]
+    frames = np.lib.stride_tricks.as_strided(
+        data, shape=(nframes, n), strides=(hop * stride, stride))
+
+    # compute the power of all the frames at once (leaving out the DC
+    # component, as in `freq_power`)
+    fft = np.fft.rfft(frames * window, axis=1)[:, 1:n/2]
+    power = (fft.real ** 2 + fft.imag ** 2).astype('f4')
+    freq = rate * np.arange(1, n/2) / float(n)
+    times = (np.arange(nframes) * hop + n / 2.) / rate
+
+    return freq, times, power
+
+
 def plot_power(freq, power):
     """Plot frequency vs. power of an audio signal."""
     plt.loglog(freq, power, basex=2, basey=2, color='r')
@@ -50,11 +160,10 @@ def plot_power(freq, power):
     fig.set_figheight(7)
 
 
-def bin_notes(freq, power):
-    """From the frequency and power spectrum of an audio signal, compute
-    bins corresponding to musical notes. Each bin is the mean of the
-    power spectrum for the corresponding note. Returns the log
-    frequencies, note labels, and averaged power.
+def note_bins():
+    """Compute the note labels and center frequencies of the bins used
+    by `bin_notes`, from B-1 to C8. Returns the labels, the center
+    frequencies, and the edges of the bins for the notes C0 to B8.
 
     """
     scale = ["%s%d" % (x, i) for i in xrange(9) for x in NOTES]
@@ -69,14 +178,60 @@ def bin_notes(freq, power):
     bins = np.array(bins)
 
     # halfway between B-1 and C0 to halfway between B8 and C8
-    mids = (bins[:-1] + bins[1:]) / 2.
-    lower = mids[:-1]
-    upper = mids[1:]
+    edges = (bins[:-1] + bins[1:]) / 2.
+
+    return scale, bins, edges
+
+
+# cache of the mapping from frequencies to note bins, for each set of
+# frequencies (i.e., each sampling rate and FFT size) seen so far
+_bin_index_cache = {}
+
 
-    binned = np.empty(lower.size) * np.nan
-    for i, (l, u) in enumerate(zip(lower, upper)):
-        idx = (freq >= l) & (freq < u)
-        binned[i] = np.mean(power[idx])
+def _bin_index(freq, edges):
+    """Map (sorted) frequencies to note bins. Returns the range of
+    frequencies that fall in any bin, the offsets into that range at
+    which each non-empty bin starts, which bins are non-empty, and the
+    number of frequencies in each non-empty bin.
+
+    """
+    # the frequencies are evenly spaced, so this identifies them
+    key = (freq.size, float(freq[0]), float(freq[-1]))
+    if key not in _bin_index_cache:
+        nbins = edges.size - 1
+        idx = np.searchsorted(edges, freq, side='right') - 1
+        valid = np.nonzero((idx >= 0) & (idx < nbins))[0]
+        if valid.size == 0:
+            start = stop = 0
+        else:
+            start, stop = valid[0], valid[-1] + 1
+        counts = np.bincount(idx[start:stop], minlength=nbins)[:nbins]
+        nonempty = counts > 0
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        _bin_index_cache[key] = (
+            slice(start, stop), offsets, nonempty, counts[nonempty])
+    return _bin_index_cache[key]
+
+
+def bin_notes(freq, power):
+    """From the frequency and power spectrum of an audio signal, compute
+    bins corresponding to musical notes. Each bin is the mean of the
+    power spectrum for the corresponding note. Returns the log
+    frequencies, note labels, and averaged power.
+
+    `power` can also be a spectrogram (see `spectrogram`), with
+    frequency along the last axis, in which case each frame is binned
+    separately.
+
+    """
+    scale, bins, edges = note_bins()
+    lower = edges[:-1]
+
+    binned = np.empty(power.shape[:-1] + lower.shape) * np.nan
+    valid, offsets, nonempty, counts = _bin_index(freq, edges)
+    if offsets.size > 0:
+        sums = np.add.reduceat(power[..., valid], offsets, axis=-1)
+        binned[..., nonempty] = sums / counts
 
     X = np.log2(bins[1:-1])
     Xt = scale[1:-1]
@@ -85,6 +240,31 @@ def bin_notes(freq, power):
     return X, Xt, Y
 
 
+def bin_notes_stream(blocks, rate, n=10000):
+    """Like `bin_notes`, but for an audio signal given as an iterable
+    of blocks of (at most) `n` samples, e.g. from `iter_blocks`. The
+    binned power of each block is averaged, weighted by the length of
+    the block (as in `freq_power_stream`). Returns the log
+    frequencies, note labels, and averaged power. Raises a ValueError
+    if there are no blocks (e.g. for an empty file).
+
+    """
+    total = None
+    samples = 0
+    for block in blocks:
+        freq, power = freq_power(block, rate, n=n)
+        X, Xt, Y = bin_notes(freq, power)
+        if total is None:
+            total = Y
+        else:
+            total += Y
+        samples += min(len(block), n)
+
+    if samples == 0:
+        raise ValueError("no audio data")
+    return X, Xt, total * (float(n) / samples)
+
+
 def plot_notes(bins, power):
     """Plot power for notes C through B."""
     n = len(NOTES)
@@ -99,13 +279,245 @@ def plot_notes(bins, power):
 
 
 def pick_notes(power):
-    """Identify notes from a binned power spectrum."""
+    """Identify notes from a binned power spectrum. If `power` is a
+    binned spectrogram (see `bin_notes`), returns a list of notes for
+    each frame.
+
+    """
+    # total power of each note (summed over octaves), for each frame
+    frames = np.atleast_2d(power)
     n = len(NOTES)
-    m = power.size / n
-    powers = np.nansum(power.reshape((m, n)), axis=0)
+    m = frames.shape[1] / n
+    powers = np.nansum(frames.reshape((-1, m, n)), axis=1)
 
-    best_idx = np.argmax(powers)
-    idx = powers >= (powers[best_idx] / 2.)
-    notes = list(np.array(NOTES)[idx])
+    idx = powers >= (powers.max(axis=1)[:, None] / 2.)
+    notes = [list(np.array(NOTES)[frame_idx]) for frame_idx in idx]
 
+    if power.ndim == 1:
+        return notes[0]
     return notes
+
+
+def note_track(data, rate, n=4096, hop=None, window="hann"):
+    """Identify the notes in each frame of the spectrogram of an audio
+    signal (see `spectrogram`). Returns the time at the center of each
+    frame and the list of notes for each frame.
+
+    """
+    freq, times, power = spectrogram(data, rate, n=n, hop=hop, window=window)
+    X, Xt, Y = bin_notes(freq, power)
+    return times, pick_notes(Y)
+
+
+def find_sound_files(path, extensions=(".wav",)):
+    """Recursively find all the audio files (by default, WAV files) in
+    a directory. Returns a sorted list of paths.
+
+    """
+    files = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            if os.path.splitext(filename)[1].lower() in extensions:
+                files.append(os.path.join(dirpath, filename))
+    return sorted(files)
+
+
+def analyze_file(filename, n=10000, average=False):
+    """Identify the notes in an audio file, in the same way as the
+    `sound_processing` notebook. By default, only the first `n`
+    samples are read; if `average` is True, the binned power of all
+    consecutive blocks of `n` samples is averaged instead (see
+    `bin_notes_stream`). Returns the note labels, the binned power,
+    and the list of notes. Raises a ValueError if the file is empty.
+
+    """
+    fh = Sndfile(filename, "r")
+    rate, nframes = fh.samplerate, fh.nframes
+    fh.close()
+    if nframes == 0:
+        raise ValueError("no audio data")
+    blocks = iter_blocks(filename, blocksize=n)
+    if not average:
+        first = blocks.next()
+        blocks.close()
+        blocks = [first]
+    X, Xt, Y = bin_notes_stream(blocks, rate, n=n)
+    return Xt, Y, pick_notes(Y)
+
+
+def _analyze_one(args):
+    """Wrapper around `analyze_file` for use with `Pool.imap`. Errors
+    reading the file are returned rather than raised, so that one bad
+    file doesn't stop the whole batch.
+
+    """
+    filename, n, average = args
+    try:
+        return filename, analyze_file(filename, n=n, average=average)
+    except (IOError, RuntimeError, ValueError) as err:
+        return filename, err
+
+
+def _recover_results(path):
+    """Get the files that have already been analyzed in a (possibly
+    partially written) results file, truncating it after the last
+    complete row.
+
+    """
+    with open(path, "rb+") as fh:
+        contents = fh.read()
+        end = contents.rfind("\n") + 1
+        if end < len(contents):
+            fh.truncate(end)
+    rows = list(csv.reader(contents[:end].splitlines()))
+    return set(row[0] for row in rows[1:])
+
+
+def analyze_files(files, output, nprocs=None, n=10000, average=False):
+    """Identify the notes in a list of audio files, in parallel, and
+    write the results to a CSV file with one row per file. The columns
+    are the filename, the notes (joined by "+"), and the binned power
+    for each note (see `bin_notes`).
+
+    Each row is written as soon as the file is analyzed, so if
+    `output` already exists (e.g. from a run that was interrupted),
+    files that are already in it are skipped and new rows are appended.
+    Files that can't be read are reported and skipped.
+
+    Parameters
+    ----------
+    files : list
+        List of paths to audio files
+    output : string
+        Path to the CSV file to write
+    nprocs : int (optional)
+        Number of worker processes to use. If 1, the files are
+        processed serially in the current process; if None, one
+        process per CPU is used.
+    n : int (optional)
+        Number of samples per FFT (see `freq_power`)
+    average : bool (optional)
+        Whether to average over the whole file (see `analyze_file`)
+
+    Returns
+    -------
+    count : int
+        Number of files analyzed
+    failed : int
+        Number of files that couldn't be read (and were skipped)
+    elapsed : float
+        Time taken to analyze them (in seconds)
+
+    """
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+
+    done = set()
+    if os.path.exists(output):
+        done = _recover_results(output)
+    todo = [(x, n, average) for x in files if x not in done]
+    if len(todo) < len(files):
+        print "Resuming: %d / %d files already in '%s'" % (
+            len(files) - len(todo), len(files), output)
+
+    # the order of the rows doesn't matter, so take the results as
+    # soon as they are ready
+    pool = None
+    if nprocs > 1 and len(todo) > 1:
+        chunksize = max(1, min(64, len(todo) / (4 * nprocs)))
+        pool = multiprocessing.Pool(nprocs)
+        results = pool.imap_unordered(_analyze_one, todo, chunksize)
+    else:
+        results = imap(_analyze_one, todo)
+
+    count = 0
+    failed = 0
+    msg = ""
+    start = time.time()
+    try:
+        with open(output, "ab") as fh:
+            fh.seek(0, os.SEEK_END)
+            writer = csv.writer(fh)
+            for filename, result in results:
+                # clear the progress message
+                sys.stdout.write(" "*len(msg) + "\r")
+
+                if isinstance(result, Exception):
+                    print "Skipping '%s': %s" % (filename, result)
+                    failed += 1
+                else:
+                    labels, power, notes = result
+                    if fh.tell() == 0:
+                        writer.writerow(
+                            ["filename", "notes"] + list(labels))
+                    writer.writerow(
+                        [filename, "+".join(notes)] +
+                        ["%.6g" % x for x in power])
+                    fh.flush()
+                    count += 1
+
+                # display progress (files that couldn't be read count
+                # towards the total, but are reported separately)
+                elapsed = time.time() - start
+                msg = "[%d / %d] %.1f files/s" % (
+                    count + failed, len(todo), count / elapsed)
+                if failed > 0:
+                    msg += ", %d skipped" % failed
+                sys.stdout.write(msg + "\r")
+                sys.stdout.flush()
+
+        sys.stdout.write(" "*len(msg) + "\r")
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return count, failed, time.time() - start
+
+
+def load_results(path):
+    """Load the results written by `analyze_files`. Returns the
+    filenames, the notes for each file, the note labels, and the (M,
+    N) array of binned power, where M is the number of files and N is
+    the number of notes.
+
+    """
+    with open(path, "rb") as fh:
+        rows = list(csv.reader(fh))
+    if not rows:
+        return [], [], [], np.empty((0, 0))
+    labels = rows[0][2:]
+    filenames = [row[0] for row in rows[1:]]
+    notes = [row[1].split("+") if row[1] else [] for row in rows[1:]]
+    power = np.array([row[2:] for row in rows[1:]], dtype=float)
+    power = power.reshape((len(filenames), len(labels)))
+    return filenames, notes, labels, power
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    # whether to average over the whole of each file
+    average = "--average" in args
+    if average:
+        args.remove("--average")
+
+    if len(args) < 2:
+        print "Invalid number of arguments (expected 'path output')."
+        sys.exit(1)
+
+    # number of worker processes (defaults to one per CPU)
+    if len(args) > 2:
+        nprocs = int(args[2])
+    else:
+        nprocs = None
+
+    files = find_sound_files(args[0])
+    count, failed, elapsed = analyze_files(
+        files, args[1], nprocs=nprocs, average=average)
+    print "Analyzed %d files in %.1fs (%.1f files/s)" % (
+        count, elapsed, count / elapsed if elapsed > 0 else 0.)
+    if failed > 0:
+        print "Skipped %d files that could not be read" % failed
+    print "Saved results to '%s'" % args[1]
@@ -0,0 +1,135 @@
+"""Tests for sound.py
+
+Run with `nosetests` (or `py.test`) from this directory.
+
+"""
+
+# external
+import numpy as np
+# local
+import sound
+
+
+def make_signal(size, rate=44100, seed=0):
+    """Generate a signal made of a few notes plus some noise."""
+    rso = np.random.RandomState(seed)
+    t = np.arange(size) / float(rate)
+    data = rso.randn(size) * 0.1
+    for f in (261.63, 329.63, 392.00):
+        data += np.sin(2 * np.pi * f * t)
+    return data
+
+
+def blocks(data, n):
+    """Split a signal into consecutive blocks of `n` samples (the last
+    block may be shorter), like `sound.iter_blocks`.
+
+    """
+    return (data[i:i+n] for i in xrange(0, data.size, n))
+
+
+def bin_notes_loop(freq, power):
+    """The original implementation of `sound.bin_notes`, which bins
+    the power with one mask per note.
+
+    """
+    scale, bins, edges = sound.note_bins()
+    lower = edges[:-1]
+    upper = edges[1:]
+    binned = np.empty(power.shape[:-1] + lower.shape) * np.nan
+    for i, (l, u) in enumerate(zip(lower, upper)):
+        idx = (freq >= l) & (freq < u)
+        if idx.any():
+            binned[..., i] = np.mean(power[..., idx], axis=-1)
+    return np.log2(bins[1:-1]), scale[1:-1], binned
+
+
+def make_bin_freqs():
+    """Frequencies for testing `sound.bin_notes`: those of a 10000
+    point FFT at 44100 Hz, plus some that fall exactly on the edges of
+    the bins, minus those in one of the bins (so that it is empty).
+
+    """
+    scale, bins, edges = sound.note_bins()
+    freq = 44100 * np.arange(1, 5000) / 10000.
+    freq = freq[(freq < edges[40]) | (freq >= edges[41])]
+    return np.sort(np.r_[freq, edges[30:35], edges[50]])
+
+
+def assert_bin_notes_equal(freq, power):
+    X, Xt, Y = sound.bin_notes(freq, power)
+    eX, eXt, eY = bin_notes_loop(freq, power)
+    assert np.allclose(X, eX)
+    assert list(Xt) == list(eXt)
+    assert Y.shape == eY.shape
+    assert (np.isnan(Y) == np.isnan(eY)).all()
+    assert np.allclose(Y[~np.isnan(Y)], eY[~np.isnan(eY)])
+
+
+def test_bin_notes():
+    freq = make_bin_freqs()
+    power = np.random.RandomState(0).rand(freq.size)
+    # the low notes are narrower than the frequency spacing, so some of
+    # them are empty, as is the one we removed
+    X, Xt, Y = sound.bin_notes(freq, power)
+    assert np.isnan(Y[40])
+    assert np.isnan(Y[:12]).any()
+    assert_bin_notes_equal(freq, power)
+
+
+def test_bin_notes_spectrogram():
+    freq = make_bin_freqs()
+    power = np.random.RandomState(1).rand(7, freq.size)
+    assert_bin_notes_equal(freq, power)
+
+    # each frame should be binned the same way as on its own
+    X, Xt, Y = sound.bin_notes(freq, power)
+    for frame, binned in zip(power, Y):
+        assert_bin_notes_equal(freq, frame)
+        fX, fXt, fY = sound.bin_notes(freq, frame)
+        assert np.allclose(fY[~np.isnan(fY)], binned[~np.isnan(binned)])
+
+
+def test_freq_power_stream():
+    data = make_signal(35000)
+    freq, power = sound.freq_power(data, 44100, n=10000, average=True)
+    sfreq, spower = sound.freq_power_stream(blocks(data, 10000), 44100)
+    assert np.allclose(freq, sfreq)
+    assert np.allclose(power, spower)
+
+
+def test_freq_power_partial_block():
+    # one extra sample shouldn't change the average power
+    data = make_signal(30000)
+    freq, power = sound.freq_power(data, 44100, n=10000, average=True)
+    freq2, power2 = sound.freq_power(
+        np.r_[data, 0.], 44100, n=10000, average=True)
+    assert np.allclose(freq, freq2)
+    assert np.allclose(power, power2, rtol=1e-3)
+
+    # and neither should a partial block of the same signal
+    data = make_signal(35000)
+    freq3, power3 = sound.freq_power(data, 44100, n=10000, average=True)
+    ratio = power3.sum() / power.sum()
+    assert 0.95 < ratio < 1.05
+
+
+def test_bin_notes_stream():
+    data = make_signal(35000)
+    freq, power = sound.freq_power(data, 44100, n=10000, average=True)
+    X, Xt, Y = sound.bin_notes(freq, power)
+    sX, sXt, sY = sound.bin_notes_stream(blocks(data, 10000), 44100)
+    assert np.allclose(X, sX)
+    assert list(Xt) == list(sXt)
+    assert np.allclose(Y[~np.isnan(Y)], sY[~np.isnan(Y)])
+    assert (np.isnan(Y) == np.isnan(sY)).all()
+
+
+def test_stream_empty():
+    for func in (sound.freq_power_stream, sound.bin_notes_stream):
+        try:
+            func(iter([]), 44100)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("expected a ValueError")
@@ -0,0 +1,116 @@
+"""Benchmark inserting weather data into the database
+
+Compares the rate (rows per second) at which weather data can be
+inserted into the weather table by the original approach (one
+string-formatted INSERT statement per row, as the notebook used to
+do) and by `ingest.insert_weather` (`executemany` with parameter
+binding, in batched transactions). Each approach writes to a fresh
+database file in a temporary directory.
+
+To run the benchmark on synthetic data (about five years of daily
+weather for 50 airports):
+
+`python benchmark_ingest.py`
+
+or on weather data that has already been downloaded:
+
+`python benchmark_ingest.py weather_data`
+
+"""
+
+# built-in
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from glob import glob
+# external
+import numpy as np
+import pandas as pd
+# local
+import ingest
+import util
+
+
+def make_weather(nairports=50, ndays=365 * 5, rso=None):
+    """Generate synthetic weather data, with the same columns as
+    `util.load_weather`.
+
+    """
+    if rso is None:
+        rso = np.random
+    n = nairports * ndays
+    dates = pd.date_range("2008-01-01", periods=ndays).format()
+    data = pd.DataFrame({
+        'ICAO': np.repeat(["K%03d" % i for i in xrange(nairports)], ndays),
+        'Date': np.tile(dates, nairports),
+        'Min TemperatureF': rso.randint(0, 60, n).astype(float),
+        'Max TemperatureF': rso.randint(60, 110, n).astype(float),
+        'Min Humidity': rso.randint(0, 50, n).astype(float),
+        'Max Humidity': rso.randint(50, 100, n).astype(float),
+        'PrecipitationIn': rso.rand(n).round(2),
+        'CloudCover': rso.randint(0, 9, n).astype(float),
+    }, columns=util.WEATHER_COLUMNS)
+    # some values are missing in the real data
+    data.loc[rso.rand(n) < 0.1, 'CloudCover'] = np.nan
+    return data
+
+
+def insert_rowwise(connection, data):
+    """Insert weather data one row at a time, in the way the notebook
+    originally did, committing after each airport and month.
+
+    """
+    cursor = connection.cursor()
+    cols, data_cols = zip(*ingest.WEATHER_COLUMNS)
+    sql_cmd = """INSERT INTO weather (%s) VALUES %s"""
+    months = data['Date'].str.slice(0, 7)
+    for key, group in data[list(data_cols)].groupby([data['ICAO'], months]):
+        for idx, row in group.iterrows():
+            # filter out entries which are NaN
+            cols_, row = zip(*filter(
+                lambda x: not (isinstance(x[1], float) and np.isnan(x[1])),
+                zip(cols, row)))
+            row = tuple(map(str, row))
+            cursor.execute(sql_cmd % (", ".join(cols_), str(row)))
+        connection.commit()
+    cursor.execute("CREATE INDEX weather_icao_date ON weather (icao, date)")
+    connection.commit()
+    return len(data)
+
+
+def insert_bulk(connection, data):
+    return ingest.insert_weather(connection, data)
+
+
+def benchmark(data):
+    """Time inserting the data with each approach, and print the number
+    of rows inserted per second.
+
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        print "%-10s %10s %10s %12s" % ("method", "rows", "time (s)", "rows/s")
+        for name, func in [("rowwise", insert_rowwise),
+                           ("bulk", insert_bulk)]:
+            connection = sqlite3.connect(os.path.join(tmpdir, name + ".db"))
+            ingest.create_weather(connection)
+            start = time.time()
+            count = func(connection, data)
+            elapsed = time.time() - start
+            connection.close()
+            print "%-10s %10d %10.3f %12.1f" % (
+                name, count, elapsed, count / elapsed)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        filenames = sorted(glob(os.path.join(sys.argv[1], "*.csv")))
+        data = util.load_weather_many(filenames, cache=None)
+    else:
+        data = make_weather(rso=np.random.RandomState(0))
+    benchmark(data)
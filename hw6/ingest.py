@@ -0,0 +1,214 @@
+"""Bulk loading of the airport and weather data into the database.
+
+Rows are inserted with `executemany` and parameter binding (so values
+containing quotes are handled correctly), in transactions of a fixed
+number of rows, rather than as one formatted INSERT statement per row.
+
+"""
+
+import sqlite3
+from contextlib import contextmanager
+import pandas as pd
+import util
+
+# map from weather table columns to columns of the weather data (see
+# `util.load_weather`)
+WEATHER_COLUMNS = [
+    ('icao', 'ICAO'),
+    ('date', 'Date'),
+    ('min_temp', 'Min TemperatureF'),
+    ('max_temp', 'Max TemperatureF'),
+    ('min_humidity', 'Min Humidity'),
+    ('max_humidity', 'Max Humidity'),
+    ('precipitation', 'PrecipitationIn'),
+    ('cloud_cover', 'CloudCover'),
+]
+
+CREATE_TOP_AIRPORTS = """CREATE TABLE top_airports (id INTEGER PRIMARY
+KEY AUTOINCREMENT, city TEXT, faa TEXT, iata TEXT, icao TEXT, airport
+TEXT, role TEXT, enplanements INTEGER)"""
+
+CREATE_ICAO = """CREATE TABLE icao (id INTEGER PRIMARY KEY, ident TEXT,
+type TEXT, name TEXT, latitude_deg FLOAT, longitude_deg FLOAT,
+elevation_ft INTEGER, continent TEXT, iso_country TEXT, iso_region
+TEXT, municipality TEXT, scheduled_service TEXT, gps_code TEXT,
+iata_code TEXT, local_code TEXT, home_link TEXT, wikipedia_link TEXT,
+keywords TEXT)"""
+
+CREATE_AIRPORTS = """CREATE TABLE airports (icao TEXT PRIMARY KEY, name
+TEXT, city TEXT, latitude FLOAT, longitude FLOAT)"""
+
+CREATE_WEATHER = """CREATE TABLE weather (id INTEGER PRIMARY KEY
+AUTOINCREMENT, icao TEXT, date TEXT, min_temp INTEGER, max_temp
+INTEGER, min_humidity INTEGER, max_humidity INTEGER, precipitation
+FLOAT, cloud_cover INTEGER)"""
+
+
+def _decode(x):
+    if isinstance(x, str):
+        return x.decode("utf-8")
+    return x
+
+
+def records(df):
+    """Convert a DataFrame into a list of tuples of Python objects that
+    can be passed to sqlite, with NaN converted to None (i.e. NULL) and
+    strings decoded from UTF-8 (sqlite only accepts unicode strings).
+
+    """
+    values = df.astype(object).values
+    values[pd.isnull(values)] = None
+    for j, dtype in enumerate(df.dtypes):
+        if dtype == object:
+            values[:, j] = map(_decode, values[:, j])
+    return [tuple(row) for row in values.tolist()]
+
+
+@contextmanager
+def bulk_load(connection):
+    """Context manager which sets up a connection for loading lots of
+    data: the database is switched to write-ahead logging, and syncing
+    to disk is turned off until the load is done. Both settings are
+    restored afterwards.
+
+    """
+    cursor = connection.cursor()
+    connection.commit()
+    journal_mode = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+    synchronous = cursor.execute("PRAGMA synchronous").fetchone()[0]
+    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.execute("PRAGMA synchronous = OFF")
+    try:
+        yield connection
+        connection.commit()
+    finally:
+        connection.rollback()
+        cursor.execute("PRAGMA synchronous = %d" % synchronous)
+        cursor.execute("PRAGMA journal_mode = %s" % journal_mode)
+
+
+def insert_rows(connection, table, columns, rows, batch_size=10000):
+    """Insert rows into a table, committing every `batch_size` rows.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        The database connection
+    table : string
+        Name of the table
+    columns : list
+        Names of the columns to insert
+    rows : iterable
+        Tuples of values, one for each column
+    batch_size : integer (optional)
+        Number of rows to insert in each transaction
+
+    Returns
+    -------
+    integer : number of rows inserted
+
+    """
+    sql_cmd = "INSERT INTO %s (%s) VALUES (%s)" % (
+        table, ", ".join(columns), ", ".join("?" * len(columns)))
+    rows = list(rows)
+    cursor = connection.cursor()
+    for i in xrange(0, len(rows), batch_size):
+        cursor.executemany(sql_cmd, rows[i:i + batch_size])
+        connection.commit()
+    return len(rows)
+
+
+def insert_frame(connection, table, df, batch_size=10000):
+    """Insert the rows of a DataFrame into a table whose columns have
+    the same names as the DataFrame's columns (see `insert_rows`).
+
+    """
+    columns = map(str, df.columns)
+    return insert_rows(
+        connection, table, columns, records(df), batch_size=batch_size)
+
+
+def create_airports(connection, top_airports, icao):
+    """Create the airports table from the top airports and ICAO airport
+    data, replacing it if it already exists.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        The database connection
+    top_airports : pd.DataFrame
+        The contents of top_airports.csv
+    icao : pd.DataFrame
+        The contents of ICAO_airports.csv
+
+    """
+    # load the csv data into temporary tables in memory, and join them
+    # to get the data we want for the airports table
+    tmp = sqlite3.connect(":memory:")
+    tmp.execute(CREATE_TOP_AIRPORTS)
+    tmp.execute(CREATE_ICAO)
+    insert_frame(tmp, "top_airports", top_airports)
+    insert_frame(tmp, "icao", icao)
+    rows = tmp.execute(
+        """SELECT top_airports.icao, icao.name, top_airports.city,
+        icao.latitude_deg, icao.longitude_deg FROM top_airports LEFT
+        JOIN icao ON top_airports.icao == icao.ident""").fetchall()
+    tmp.close()
+
+    with bulk_load(connection):
+        connection.execute("DROP TABLE IF EXISTS airports")
+        connection.execute(CREATE_AIRPORTS)
+        insert_rows(connection, "airports",
+                    ["icao", "name", "city", "latitude", "longitude"], rows)
+
+
+def create_weather(connection):
+    """Create the (empty) weather table, replacing it if it already
+    exists.
+
+    """
+    connection.execute("DROP TABLE IF EXISTS weather")
+    connection.execute("DROP INDEX IF EXISTS weather_icao_date")
+    connection.execute(CREATE_WEATHER)
+    connection.commit()
+
+
+def insert_weather(connection, data, batch_size=10000):
+    """Insert weather data into the weather table, and then (re)create
+    the index on airport and date. The index is dropped during the
+    insert, because it is faster to build it once at the end than to
+    update it for every row.
+
+    Parameters
+    ----------
+    connection : sqlite3.Connection
+        The database connection
+    data : pd.DataFrame
+        Weather data, as returned by `util.load_weather` or
+        `util.load_weather_many`
+    batch_size : integer (optional)
+        Number of rows to insert in each transaction
+
+    Returns
+    -------
+    integer : number of rows inserted
+
+    """
+    columns, data_columns = zip(*WEATHER_COLUMNS)
+    with bulk_load(connection):
+        connection.execute("DROP INDEX IF EXISTS weather_icao_date")
+        count = insert_rows(
+            connection, "weather", columns,
+            records(data[list(data_columns)]), batch_size=batch_size)
+        connection.execute(
+            "CREATE INDEX weather_icao_date ON weather (icao, date)")
+    return count
+
+
+def load_weather(connection, filenames, batch_size=10000, **kwargs):
+    """Load weather data files (see `util.load_weather_many`) and insert
+    them into the weather table. Returns the number of rows inserted.
+
+    """
+    data = util.load_weather_many(filenames, **kwargs)
+    return insert_weather(connection, data, batch_size=batch_size)
@@ -0,0 +1,337 @@
+"""Tests for util.py
+
+The weather downloader is tested against a local HTTP server standing
+in for wunderground.com. Run with `nosetests` (or `py.test`) from this
+directory.
+
+"""
+
+# built-in
+import os
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+# external
+import numpy as np
+import pandas as pd
+# local
+import util
+
+CSV = "PST,Max TemperatureF<br />\n2013-1-1,50<br />\n"
+
+
+class WeatherHandler(BaseHTTPRequestHandler):
+    """Serves fake weather data. Requests for airport 'KBAD' fail with
+    a 404, requests for 'KMOV' are redirected to 'KSFO', and the first
+    request for each month of 'KBSY' fails with a 503.
+
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.clients.add(self.client_address)
+            count = server.requests.count(self.path)
+
+        headers = {}
+        if "/KBAD/" in self.path:
+            status, body = 404, "Not found"
+        elif "/KMOV/" in self.path:
+            status, body = 302, ""
+            headers["Location"] = self.path.replace("/KMOV/", "/KSFO/")
+        elif "/KBSY/" in self.path and count == 1:
+            status, body = 503, "Busy"
+        else:
+            status, body = 200, CSV
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class WeatherServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TestDownloadWeather(object):
+
+    def setup(self):
+        self.server = WeatherServer(("127.0.0.1", 0), WeatherHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.clients = set()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "weather_data")
+
+    def teardown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def download(self, months, **kwargs):
+        results = util.download_weather_many(
+            months, url=self.url, path=self.path, backoff=0.01, **kwargs)
+        return dict(((c, y, m), r) for c, y, m, r in results)
+
+    def test_download(self):
+        months = [(c, 2012, m) for c in ("KSFO", "KJFK") for m in (1, 2, 3)]
+        results = self.download(months, nthreads=2)
+        assert sorted(results) == sorted(months)
+        for code, year, month in months:
+            filename = results[(code, year, month)]
+            assert filename == os.path.join(
+                self.path, "%s-%s-%s.csv" % (code, year, month))
+            with open(filename, "r") as fh:
+                assert fh.read() == CSV.strip().replace("<br />", "")
+        # no temporary files are left behind
+        assert len(os.listdir(self.path)) == len(months)
+        # connections are reused between requests
+        assert len(self.server.requests) == len(months)
+        assert len(self.server.clients) <= 2
+
+    def test_skip_existing(self):
+        self.download([("KSFO", 2012, 1)])
+        self.download([("KSFO", 2012, 1)])
+        assert len(self.server.requests) == 1
+
+    def test_retry(self):
+        results = self.download([("KBSY", 2012, 1)])
+        assert os.path.exists(results[("KBSY", 2012, 1)])
+        assert len(self.server.requests) == 2
+
+    def test_not_found(self):
+        results = self.download([("KBAD", 2012, 1), ("KSFO", 2012, 1)])
+        assert isinstance(results[("KBAD", 2012, 1)], IOError)
+        assert os.path.exists(results[("KSFO", 2012, 1)])
+        # client errors aren't retried
+        assert len(self.server.requests) == 2
+        assert os.listdir(self.path) == ["KSFO-2012-1.csv"]
+
+    def test_redirect(self):
+        results = self.download([("KMOV", 2012, 1)])
+        with open(results[("KMOV", 2012, 1)], "r") as fh:
+            assert fh.read() == CSV.strip().replace("<br />", "")
+        assert len(self.server.requests) == 2
+
+    def test_write_error(self):
+        # the data directory can't be created, because a file is in
+        # the way; the error is returned rather than raised
+        with open(self.path, "w"):
+            pass
+        results = self.download([("KSFO", 2012, 1), ("KJFK", 2012, 1)])
+        assert all(isinstance(r, EnvironmentError) for r in results.values())
+
+
+def make_frame(seed=0):
+    """Generate a small DataFrame of correlated values for a few
+    cities, with some missing values.
+
+    """
+    rso = np.random.RandomState(seed)
+    X = rso.randn(40, 4)
+    X[:, 1] += X[:, 0]
+    X[1:, 2] += X[:-1, 0]
+    X[rso.rand(*X.shape) < 0.2] = np.nan
+    return pd.DataFrame(X, columns=["KSFO", "KJFK", "KORD", "KBOS"])
+
+
+def expected_corr(df, city1, city2, offset):
+    """Compute the correlation between `city1` and `city2` `offset`
+    days later with `np.corrcoef`, from the rows where both are
+    present.
+
+    """
+    a = np.asarray(df[city1])[:len(df) - offset]
+    b = np.asarray(df[city2])[offset:]
+    ok = ~np.isnan(a) & ~np.isnan(b)
+    return np.corrcoef(a[ok], b[ok])[0, 1]
+
+
+def test_correlate():
+    df = make_frame()
+    result = util.correlate(df, offsets=(0, 2))
+    assert len(result) == 2 * 4 * 4
+    for _, row in result.iterrows():
+        expected = expected_corr(df, row['city1'], row['city2'],
+                                 row['offset'])
+        assert np.allclose(row['corr'], expected)
+
+
+def test_correlate_no_missing():
+    df = make_frame().fillna(0)
+    result = util.correlate(df, offsets=(0, 3))
+    for _, row in result.iterrows():
+        expected = expected_corr(df, row['city1'], row['city2'],
+                                 row['offset'])
+        assert np.allclose(row['corr'], expected)
+
+
+def test_correlate_all_missing():
+    df = make_frame()
+    df['KBOS'] = np.nan
+    result = util.correlate(df, offsets=(0, 1))
+    missing = (result['city1'] == 'KBOS') | (result['city2'] == 'KBOS')
+    assert np.isnan(result['corr'][missing]).all()
+    assert not np.isnan(result['corr'][~missing]).any()
+
+
+def make_locations():
+    """Latitude and longitude of a few airports."""
+    return pd.DataFrame({
+        "KSFO": [37.6189, -122.3750],
+        "KJFK": [40.6398, -73.7789],
+        "KLAX": [33.9425, -118.4081],
+        "KORD": [41.9786, -87.9048],
+    }, index=["latitude", "longitude"], columns=[
+        "KSFO", "KJFK", "KLAX", "KORD"])
+
+
+def test_distance_matrix():
+    ll = make_locations()
+    dist, lat_dist, long_dist = util.distance_matrix(ll)
+    # SFO to JFK is about 4150 km
+    assert abs(dist["KSFO"]["KJFK"] - 4150) < 20
+    assert np.allclose(np.diag(dist), 0)
+    assert np.allclose(dist.values, dist.values.T)
+    assert np.allclose(lat_dist["KSFO"]["KJFK"], 40.6398 - 37.6189)
+    assert np.allclose(long_dist["KSFO"]["KJFK"], 122.3750 - 73.7789)
+
+
+def test_calc_dist():
+    ll = make_locations()
+    dist, lat_dist, long_dist = util.distance_matrix(ll)
+
+    result = util.calc_dist(ll)
+    assert len(result) == 4 * 4
+    for _, row in result.iterrows():
+        assert row['distance'] == dist[row['city1']][row['city2']]
+
+    result = util.calc_dist(ll, triangle=True)
+    pairs = [frozenset(x) for x in zip(result['city1'], result['city2'])]
+    # each pair of different cities appears exactly once
+    assert len(pairs) == 4 * 3 / 2
+    assert len(set(pairs)) == len(pairs)
+    assert all(len(pair) == 2 for pair in pairs)
+    for _, row in result.iterrows():
+        assert row['distance'] == dist[row['city1']][row['city2']]
+
+
+WEATHER_FILES = {
+    "KSFO-2012-1.csv": (
+        "PST,Max TemperatureF,Mean TemperatureF,Min TemperatureF,"
+        "Max Humidity, Mean Humidity, Min Humidity, PrecipitationIn,"
+        " CloudCover, Events\n"
+        "2012-1-1,55,50,45,90,70,50,0.00,5,\n"
+        "2012-1-2,56,51,46,95,80,60,T,8,Rain\n"
+        "2012-1-3,57,52,47,85,,55,0.25,,Rain\n"),
+    "KJFK-2012-1.csv": (
+        "EST,Max TemperatureF,Mean TemperatureF,Min TemperatureF,"
+        "Max Humidity, Mean Humidity, Min Humidity, PrecipitationIn,"
+        " CloudCover, Events\n"
+        "2012-1-1,40,35,30,80,65,50,0.10,7,Snow\n"
+        "2012-1-2,42,36,31,75,60,45,0.00,2,\n"),
+}
+
+
+class TestLoadWeather(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for name in sorted(WEATHER_FILES):
+            path = os.path.join(self.tmpdir, name)
+            with open(path, "w") as fh:
+                fh.write(WEATHER_FILES[name])
+            self.paths.append(path)
+        self.cache = os.path.join(self.tmpdir, "weather_data.npz")
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def load(self, **kwargs):
+        kwargs.setdefault('nprocs', 1)
+        kwargs.setdefault('cache', self.cache)
+        return util.load_weather_many(self.paths, **kwargs)
+
+    def assert_frames_equal(self, data, expected):
+        assert list(data.columns) == util.WEATHER_COLUMNS
+        assert len(data) == len(expected)
+        for x in util.WEATHER_NUMERIC:
+            assert data[x].dtype == np.dtype('f8')
+            assert np.allclose(data[x], expected[x].astype(float),
+                               equal_nan=True)
+        for x in ('ICAO', 'Date'):
+            assert list(data[x]) == list(expected[x])
+
+    def expected(self):
+        """Load the files with `load_weather`, and read trace
+        precipitation as zero.
+
+        """
+        expected = pd.concat(map(util.load_weather, self.paths),
+                             ignore_index=True)
+        expected['PrecipitationIn'] = expected['PrecipitationIn'].replace(
+            'T', '0')
+        return expected
+
+    def test_load(self):
+        expected = self.expected()
+        assert np.isnan(expected['CloudCover'].astype(float)).sum() == 1
+        for nprocs in (1, 2):
+            data = self.load(nprocs=nprocs, cache=None)
+            self.assert_frames_equal(data, expected)
+        assert data['PrecipitationIn'][3] == 0
+        assert list(data['ICAO'].unique()) == ["KJFK", "KSFO"]
+
+    def test_cache(self):
+        data = self.load()
+        assert os.path.exists(self.cache)
+
+        # the files aren't parsed again if they haven't changed
+        parse_weather = util._parse_weather
+        util._parse_weather = None
+        try:
+            self.assert_frames_equal(self.load(), data)
+        finally:
+            util._parse_weather = parse_weather
+
+    def test_cache_mtime(self):
+        self.load()
+        # same size, different contents and modification time
+        path = self.paths[1]
+        st = os.stat(path)
+        with open(path, "w") as fh:
+            fh.write(WEATHER_FILES["KSFO-2012-1.csv"].replace(",55,", ",65,"))
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+        assert os.path.getsize(path) == st.st_size
+        data = self.load()
+        assert data['Max TemperatureF'][2] == 65
+        self.assert_frames_equal(data, self.expected())
+
+    def test_cache_size(self):
+        self.load()
+        # different size, same modification time
+        path = self.paths[0]
+        st = os.stat(path)
+        with open(path, "a") as fh:
+            fh.write("2012-1-3,44,38,32,70,55,40,0.00,3,\n")
+        os.utime(path, (st.st_atime, st.st_mtime))
+        data = self.load()
+        assert len(data) == 6
+        self.assert_frames_equal(data, self.expected())
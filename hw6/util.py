@@ -1,9 +1,206 @@
+import httplib
+import multiprocessing
 import os
-import urllib
+import socket
+import tempfile
+import threading
+import time
+import urlparse
+import warnings
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
-from itertools import product
+from multiprocessing.pool import ThreadPool
+
+
+# where to download the weather data from
+WEATHER_URL = "http://www.wunderground.com"
+WEATHER_PATH = "/history/airport/%s/%d/%d/1/MonthlyHistory.html?format=1"
+
+# HTTP status codes of redirects which are followed
+REDIRECTS = (301, 302, 303, 307)
+
+
+class WeatherDownloader(object):
+    """Downloads monthly weather data from wunderground.com and saves
+    it to file. Each thread using the downloader gets its own
+    persistent (keep-alive) connection to the server, which is reused
+    for every download made from that thread.
+
+    Parameters
+    ----------
+    url : string (optional)
+        Base URL of the server to download from
+    path : string (optional)
+        Directory to save the data files in
+    retries : integer (optional)
+        Number of times to retry a download that fails because of a
+        network error or a server error (5xx status)
+    backoff : float (optional)
+        Time (in seconds) to wait before the first retry; the wait is
+        doubled for each subsequent retry
+    timeout : float (optional)
+        Socket timeout (in seconds)
+    max_redirects : integer (optional)
+        Maximum number of redirects to follow for each request
+
+    """
+
+    def __init__(self, url=WEATHER_URL, path="weather_data", retries=3,
+                 backoff=1., timeout=60, max_redirects=5):
+        self.url = url.rstrip("/")
+        self.scheme, self.host = urlparse.urlsplit(self.url)[:2]
+        self.path = path
+        self.max_redirects = max_redirects
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def filename(self, code, year, month):
+        """Path to the data file for an airport and month."""
+        return os.path.join(self.path, "%s-%s-%s.csv" % (code, year, month))
+
+    def connection(self):
+        """Get this thread's connection to the server, creating it if
+        necessary.
+
+        """
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = self.new_connection(
+                self.scheme, self.host)
+            with self.lock:
+                self.connections.append(self.local.connection)
+        return self.local.connection
+
+    def new_connection(self, scheme, host):
+        """Open a new connection to a server."""
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def get(self, url):
+        """Make a GET request for a URL, following redirects. Requests
+        to the server given by `url` in the constructor reuse this
+        thread's connection; requests to other servers (after a
+        redirect) use a new connection. Returns the final URL and
+        response, and the body of the response.
+
+        """
+        for i in xrange(self.max_redirects + 1):
+            scheme, host, path, query = urlparse.urlsplit(url)[:4]
+            if query:
+                path += "?" + query
+            if (scheme, host) == (self.scheme, self.host):
+                conn = self.connection()
+            else:
+                conn = self.new_connection(scheme, host)
+
+            try:
+                conn.request("GET", path or "/")
+                response = conn.getresponse()
+                # the whole response has to be read before the
+                # connection can be reused
+                body = response.read()
+            finally:
+                if conn is not getattr(self.local, 'connection', None):
+                    conn.close()
+
+            location = response.getheader("location")
+            if response.status not in REDIRECTS or location is None:
+                break
+            url = urlparse.urljoin(url, location)
+
+        return url, response, body
+
+    def reset(self):
+        """Close this thread's connection to the server, so that the
+        next request opens a new one.
+
+        """
+        conn = getattr(self.local, 'connection', None)
+        if conn is not None:
+            conn.close()
+            self.local.connection = None
+            with self.lock:
+                self.connections.remove(conn)
+
+    def close(self):
+        """Close the connections of all threads."""
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+
+    def fetch(self, code, year, month):
+        """Fetch a month's worth of weather data for an airport, and
+        return it as a string. Failed requests are retried with
+        exponential backoff; if all attempts fail, the last error is
+        raised as an IOError.
+
+        """
+        url = self.url + WEATHER_PATH % (code, year, month)
+        for attempt in xrange(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                final_url, response, raw_data = self.get(url)
+            except (httplib.HTTPException, socket.error) as err:
+                # the server may have closed the connection, so open a
+                # new one for the next attempt
+                self.reset()
+                error = IOError("%s: %s" % (url, err))
+                continue
+
+            if response.status == 200:
+                return raw_data
+            error = IOError("%s: HTTP %d %s" % (
+                final_url, response.status, response.reason))
+            if response.status < 500:
+                break
+
+        raise error
+
+    def download(self, code, year, month):
+        """Download a month's worth of weather for an airport and save
+        it to file, unless the file already exists. Returns the
+        filename where the data was saved.
+
+        The data is written to a temporary file which is then renamed,
+        so an interrupted download never leaves a partial file behind.
+
+        """
+        # compute the filename, and if it exists, just return that
+        filename = self.filename(code, year, month)
+        if os.path.exists(filename):
+            return filename
+
+        # make the data directory if it does not exist
+        if not os.path.exists(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # another thread may have just created it
+                if not os.path.isdir(self.path):
+                    raise
+
+        raw_data = self.fetch(code, year, month)
+
+        # write the data to a temporary file in the same directory,
+        # and then move it into place
+        fd, tmp = tempfile.mkstemp(
+            dir=self.path, prefix=".%s." % os.path.basename(filename))
+        try:
+            with os.fdopen(fd, "w") as fh:
+                fh.write(raw_data.strip().replace("<br />", ""))
+            os.rename(tmp, filename)
+        except:
+            os.remove(tmp)
+            raise
+
+        return filename
 
 
 def download_weather(code, year, month):
@@ -23,28 +220,74 @@ def download_weather(code, year, month):
     string : filename where the data was saved
 
     """
+    downloader = WeatherDownloader()
+    try:
+        return downloader.download(code, year, month)
+    finally:
+        downloader.close()
 
-    # make the data directory if it does not exist
-    if not os.path.exists("weather_data"):
-        os.makedirs("weather_data")
 
-    # compute the filename, and if it exists, just return that
-    filename = "weather_data/%s-%s-%s.csv" % (code, year, month)
-    if os.path.exists(filename):
-        return filename
+def download_weather_many(months, nthreads=8, **kwargs):
+    """Download weather data for many airports and months concurrently
+    (see `download_weather`). Files which have already been downloaded
+    are skipped, so an interrupted run can be resumed by running it
+    again.
 
-    # compute the url to the data
-    url_fmt = ("http://www.wunderground.com/history/airport/%s/"
-               "%d/%d/1/MonthlyHistory.html?format=1")
-    url = url_fmt % (code, year, month)
-    # fetch it
-    raw_data = urllib.urlopen(url).read()
+    Parameters
+    ----------
+    months : iterable
+        Tuples of (code, year, month)
+    nthreads : integer (optional)
+        Number of downloads to run at once
+    **kwargs
+        Other arguments to `WeatherDownloader`
+
+    Yields
+    ------
+    code, year, month : the airport and month
+    result : the filename where the data was saved or, if the download
+        failed, the error (an EnvironmentError, i.e. an IOError or
+        OSError)
 
-    # write the data to file
-    with open(filename, "w") as fh:
-        fh.write(raw_data.strip().replace("<br />", ""))
+    """
+    downloader = WeatherDownloader(**kwargs)
+
+    def download(args):
+        try:
+            return args + (downloader.download(*args),)
+        except EnvironmentError as err:
+            return args + (err,)
 
-    return filename
+    pool = ThreadPool(nthreads)
+    try:
+        for result in pool.imap_unordered(download, months):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+        downloader.close()
+
+
+# the time zones used as the name of the date column in the weather
+# data; we only care about dates, not actual times
+TIMEZONES = ['PST', 'PDT', 'EST', 'EDT', 'CST', 'CDT', 'MST', 'MDT',
+             'HST', 'AST']
+
+# the columns we want to extract from the weather data
+WEATHER_COLUMNS = [
+    'ICAO',
+    'Date',
+    'Min TemperatureF',
+    'Max TemperatureF',
+    'Min Humidity',
+    'Max Humidity',
+    'PrecipitationIn',
+    'CloudCover'
+]
+
+# the numeric weather columns, which are parsed as floats (rather than
+# integers) so that missing values can be represented as NaN
+WEATHER_NUMERIC = WEATHER_COLUMNS[2:]
 
 
 def load_weather(filename):
@@ -70,33 +313,11 @@ def load_weather(filename):
     data['ICAO'] = os.path.split(filename)[1].split("-")[0]
     # convert time zones into something standard; we only care about
     # dates, not actual times
-    data.rename(columns={
-        'PST': 'Date',
-        'PDT': 'Date',
-        'EST': 'Date',
-        'EDT': 'Date',
-        'CST': 'Date',
-        'CDT': 'Date',
-        'MST': 'Date',
-        'MDT': 'Date',
-        'HST': 'Date',
-        'AST': 'Date',
-    }, inplace=True)
-
-    # the columns we want to extract from this data
-    cols = [
-        'ICAO',
-        'Date',
-        'Min TemperatureF',
-        'Max TemperatureF',
-        'Min Humidity',
-        'Max Humidity',
-        'PrecipitationIn',
-        'CloudCover'
-    ]
+    data.rename(columns=dict((tz, 'Date') for tz in TIMEZONES),
+                inplace=True)
 
     try:
-        ret = data[cols]
+        ret = data[WEATHER_COLUMNS]
     except:
         print data
         raise
@@ -104,73 +325,295 @@ def load_weather(filename):
     return ret
 
 
-def correlate(df):
+def _parse_precipitation(x):
+    """Parse a precipitation value, where "T" means a trace amount."""
+    x = x.strip()
+    if x == "":
+        return np.nan
+    if x == "T":
+        return 0.
+    return float(x)
+
+
+def _parse_weather(filename):
+    """Parse a weather data file into a dictionary of numpy arrays, one
+    for each of `WEATHER_COLUMNS`. Unlike `load_weather`, the types of
+    the columns are fixed rather than inferred, and trace
+    precipitation is read as zero.
+
+    """
+    # read the header to find out what the columns are called
+    with open(filename, "r") as fh:
+        names = [x.strip() for x in fh.readline().split(",")]
+    names = ['Date' if x in TIMEZONES else x for x in names]
+    usecols = [names.index(x) for x in WEATHER_COLUMNS[1:]]
+
+    dtype = dict((x, 'f8') for x in WEATHER_NUMERIC)
+    del dtype['PrecipitationIn']
+    data = pd.read_csv(
+        filename, header=0, names=names, usecols=usecols, dtype=dtype,
+        converters={'PrecipitationIn': _parse_precipitation})
+
+    columns = dict((x, np.asarray(data[x], dtype='f8'))
+                   for x in WEATHER_NUMERIC)
+    columns['Date'] = np.asarray(data['Date'], dtype='S')
+    code = os.path.split(filename)[1].split("-")[0]
+    columns['ICAO'] = np.array([code] * len(data), dtype='S')
+    return columns
+
+
+def _weather_manifest(paths):
+    """Describe a list of weather data files by their paths, sizes
+    and modification times, to check whether a cache is up to date.
+
+    """
+    manifest = []
+    for path in paths:
+        st = os.stat(path)
+        manifest.append("%s\t%d\t%r" % (path, st.st_size, st.st_mtime))
+    return np.array("\n".join(manifest))
+
+
+def load_weather_many(paths, nprocs=None, cache="weather_data.npz"):
+    """Load the weather data from many files (see `load_weather`) into
+    a single DataFrame, parsing the files in parallel.
+
+    The combined data is saved to `cache`, with one array per column.
+    If the cache already exists and was created from the same files
+    (with the same sizes and modification times), it is loaded instead
+    of parsing the files again.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to the data files
+    nprocs : integer (optional)
+        Number of worker processes to use. If 1, the files are parsed
+        serially in the current process; if None, one process per CPU
+        is used.
+    cache : string (optional)
+        Path to the cache file, or None to not use a cache
+
+    Returns
+    -------
+    pd.DataFrame with columns `WEATHER_COLUMNS`
+
+    """
+    manifest = _weather_manifest(paths)
+
+    if cache is not None and os.path.exists(cache):
+        cached = np.load(cache)
+        try:
+            if str(cached['manifest']) == str(manifest):
+                return pd.DataFrame(
+                    dict((x, cached[x]) for x in WEATHER_COLUMNS),
+                    columns=WEATHER_COLUMNS)
+        finally:
+            cached.close()
+
+    # parse the files
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    if nprocs > 1 and len(paths) > 1:
+        pool = multiprocessing.Pool(nprocs)
+        try:
+            chunksize = max(1, len(paths) / (4 * nprocs))
+            parts = pool.map(_parse_weather, paths, chunksize)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        parts = map(_parse_weather, paths)
+
+    # copy the parts into a single set of preallocated arrays
+    sizes = [len(part['Date']) for part in parts]
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+    arrays = {}
+    for x in WEATHER_COLUMNS:
+        if x in WEATHER_NUMERIC:
+            dtype = np.dtype('f8')
+        else:
+            width = max([part[x].itemsize for part in parts] or [1])
+            dtype = np.dtype('S%d' % width)
+        arrays[x] = np.empty(sum(sizes), dtype=dtype)
+        for part, start, end in zip(parts, starts, ends):
+            arrays[x][start:end] = part[x]
+
+    if cache is not None:
+        # write to a temporary file and then rename it, so that the
+        # cache is never left partially written
+        tmp = cache + ".tmp.npz"
+        np.savez(tmp, manifest=manifest, **arrays)
+        os.rename(tmp, cache)
+
+    return pd.DataFrame(arrays, columns=WEATHER_COLUMNS)
+
+
+def correlate(df, offsets=(1, 3, 7)):
     """Compute correlations between dataframe columns (cities) using
-    different index (day) offsets.
+    different index (day) offsets. The correlation for `city1`,
+    `city2` and `offset` is between the values of `city1` on each day
+    and the values of `city2` `offset` days later.
+
+    Missing values (NaN) are allowed: each correlation is computed
+    from the days where both values are present.
 
     Parameters
     ----------
     df : pd.DataFrame
         index=date, columns=city
+    offsets : list (optional)
+        The offsets (in number of rows) to compute correlations for
 
     Returns
     -------
-    pd.DataFrame with columns: city1, city2, offset, corr
+    pd.DataFrame with columns: city1, city2, corr, offset
 
     """
 
-    corrs = []
-    offsets = [1, 3, 7]
-    it = product(enumerate(offsets), enumerate(df), enumerate(df))
+    X = np.asarray(df, dtype=float)
+    n = X.shape[1]
+
+    # standardize each city once; correlations don't change, but the
+    # sums below are better conditioned (a city with no values at all
+    # is left as NaN, and its correlations come out as NaN)
+    with warnings.catch_warnings(), np.errstate(invalid='ignore'):
+        warnings.simplefilter("ignore", RuntimeWarning)
+        X = (X - np.nanmean(X, axis=0)) / np.nanstd(X, axis=0)
 
-    for (k, offset), (i, col1), (j, col2) in it:
-        c1 = np.asarray(df[col1][:-offset])
-        c2 = np.asarray(df[col2][offset:])
-        corr = np.corrcoef(c1, c2)[1, 0]
-        corrs.append({
-            'city1': col1,
-            'city2': col2,
-            'offset': offset,
-            'corr': corr
-        })
+    corrs = np.empty((len(offsets), n, n))
+    for k, offset in enumerate(offsets):
+        corrs[k] = _lagged_corr(X[:len(X) - offset], X[offset:])
 
-    return pd.DataFrame.from_dict(corrs).drop_duplicates()
+    return pd.DataFrame({
+        'city1': np.tile(np.repeat(np.asarray(df.columns), n), len(offsets)),
+        'city2': np.tile(np.asarray(df.columns), n * len(offsets)),
+        'corr': corrs.ravel(),
+        'offset': np.repeat(offsets, n * n),
+    }, columns=['city1', 'city2', 'corr', 'offset'])
 
 
-def calc_dist(ll):
-    """Compute distances between dataframe columns (cities).
+def _lagged_corr(A, B):
+    """Compute the correlation between each column of `A` and each
+    column of `B`, ignoring rows where either value is NaN.
+
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if not (np.isnan(A).any() or np.isnan(B).any()):
+            A = (A - A.mean(axis=0)) / A.std(axis=0)
+            B = (B - B.mean(axis=0)) / B.std(axis=0)
+            return np.dot(A.T, B) / A.shape[0]
+
+        # the sums over the rows where both values are present can all
+        # be computed with matrix products, by zeroing out the missing
+        # values and using the masks of present values
+        MA = (~np.isnan(A)).astype(float)
+        MB = (~np.isnan(B)).astype(float)
+        A = np.where(MA > 0, A, 0.)
+        B = np.where(MB > 0, B, 0.)
+        N = np.dot(MA.T, MB)
+        SA = np.dot(A.T, MB)
+        SB = np.dot(MA.T, B)
+        cov = np.dot(A.T, B) - SA * SB / N
+        varA = np.dot((A ** 2).T, MB) - SA ** 2 / N
+        varB = np.dot(MA.T, B ** 2) - SB ** 2 / N
+        return cov / np.sqrt(varA * varB)
+
+
+# mean radius of the Earth, in kilometers
+EARTH_RADIUS = 6371.0
+
+
+def distance_matrix(ll):
+    """Compute distances between all pairs of dataframe columns
+    (cities).
 
     Parameters
     ----------
-    df : pd.DataFrame
+    ll : pd.DataFrame
+        index=axis (latitude, longitude), columns=city
+
+    Returns
+    -------
+    distance : pd.DataFrame
+        Great-circle distances (in kilometers), with index=city and
+        columns=city
+    latitude_distance : pd.DataFrame
+        Absolute differences in latitude (in degrees)
+    longitude_distance : pd.DataFrame
+        Absolute differences in longitude (in degrees)
+
+    """
+
+    lat = np.asarray(ll.loc['latitude'], dtype=float)
+    lon = np.asarray(ll.loc['longitude'], dtype=float)
+
+    # haversine formula, where sin((x - y) / 2) is expanded into
+    # sin(x / 2) cos(y / 2) - cos(x / 2) sin(y / 2), so that the sines
+    # and cosines only need to be computed once per city rather than
+    # once per pair (the products are done in place to save memory)
+    phi = np.radians(lat)
+    lam = np.radians(lon)
+    s, c = np.sin(phi / 2.), np.cos(phi / 2.)
+    dist = np.outer(s, c)
+    dist -= np.outer(c, s)
+    dist **= 2
+    s, c = np.sin(lam / 2.), np.cos(lam / 2.)
+    tmp = np.outer(s, c)
+    tmp -= np.outer(c, s)
+    tmp **= 2
+    tmp *= np.outer(np.cos(phi), np.cos(phi))
+    dist += tmp
+    np.clip(dist, 0, 1, out=dist)
+    np.sqrt(dist, out=dist)
+    np.arcsin(dist, out=dist)
+    dist *= 2 * EARTH_RADIUS
+
+    lat_dist = np.abs(np.subtract.outer(lat, lat))
+    long_dist = np.abs(np.subtract.outer(lon, lon))
+
+    cities = ll.columns
+    return (pd.DataFrame(dist, index=cities, columns=cities),
+            pd.DataFrame(lat_dist, index=cities, columns=cities),
+            pd.DataFrame(long_dist, index=cities, columns=cities))
+
+
+def calc_dist(ll, triangle=False):
+    """Compute distances between dataframe columns (cities). See
+    `distance_matrix`.
+
+    Parameters
+    ----------
+    ll : pd.DataFrame
         index=axis (latitude, longitude), columns=city
+    triangle : boolean (optional)
+        If True, only include each pair of (different) cities once,
+        rather than every ordered pair
 
     Returns
     -------
     pd.DataFrame with columns: city1, city2, distance,
-    longitude_distance, latitude_distance
+    latitude_distance, longitude_distance
 
     """
 
-    dists = []
-    it = product(ll, ll)
-
-    for city1, city2 in it:
-        ll1 = ll[city1]
-        ll2 = ll[city2]
-        diff = (ll1 - ll2)
-        dist = np.sqrt(diff['latitude'] ** 2 + diff['longitude'] ** 2)
-        long_dist = np.abs(diff['longitude'])
-        lat_dist = np.abs(diff['latitude'])
-        dists.append({
-            'city1': city1,
-            'city2': city2,
-            'distance': dist,
-            'longitude_distance': long_dist,
-            'latitude_distance': lat_dist
-        })
-
-    return pd.DataFrame.from_dict(dists).drop_duplicates()
+    dist, lat_dist, long_dist = distance_matrix(ll)
+    n = len(ll.columns)
+    if triangle:
+        i, j = np.triu_indices(n, 1)
+    else:
+        i, j = np.indices((n, n)).reshape((2, -1))
+
+    cities = np.asarray(ll.columns)
+    return pd.DataFrame({
+        'city1': cities[i],
+        'city2': cities[j],
+        'distance': dist.values[i, j],
+        'latitude_distance': lat_dist.values[i, j],
+        'longitude_distance': long_dist.values[i, j],
+    }, columns=['city1', 'city2', 'distance', 'latitude_distance',
+                'longitude_distance'])
 
 
 def plot(data, key):